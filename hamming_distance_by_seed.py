@@ -1,51 +1,224 @@
 """Plot 8 Hamming distance histograms, with respective averages, for a set
 of consecutive pseudorandom number generator seeds.
 
-Accepts one optional command line argument for the first seed integer.
+With --seeds, sweep any number of consecutive seeds across worker
+processes and print (or save with --output) the mean and variance of the
+distances for each seed and for the whole sweep.
 """
+import argparse
+import concurrent.futures
+import csv
+import os
 import random
 import sys
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
+import numpy as np
 
+import perf
 
-def find_hamming_distances(seed):
-    """Return list of Hamming distances for all pairs of 64 bit
-    pseudorandom numbers.
+NUMBERS_PER_SEED = 781
+# Rows of pairs XORed at once. A block of 1024 x 1024 pairs takes 8 MB.
+BLOCK_SIZE = 1024
+# Hamming distances between 64 bit numbers are 0 to 64 inclusive
+BINS = 65
+
+# Set bits of each byte value
+BYTE_POPCOUNTS = np.array([bin(i).count('1') for i in range(256)],
+                          dtype=np.uint8)
+
+
+def byte_popcount(values):
+    """Count the set bits of each uint64 with a per-byte lookup table, for
+    NumPy < 2.0, which has no np.bitwise_count.
     """
-    print(f'Calculating seed {seed}...')
-    random.seed(seed)
-    nums = [random.randint(0, 2 ** 64 - 1) for i in range(781)]
-    hamming_distances = []
-    for i, num1 in enumerate(nums[:-1]):
-        for num2 in nums[i+1:]:
-            hamming_distances.append(str(num1 ^ num2).count('1'))
-            if num1 ^ num2 == 0:
-                print(f'xor to 0: {num1}, {num2}')
+    by_byte = BYTE_POPCOUNTS[np.ascontiguousarray(values).view(np.uint8)]
+    return by_byte.reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+popcount = getattr(np, 'bitwise_count', byte_popcount)
+
+
+def random_numbers(seed, amount=NUMBERS_PER_SEED):
+    """Return 'amount' pseudorandom 64 bit numbers for a seed as a uint64
+    array. The sequence is the same as from random.randint().
+    """
+    rng = random.Random(seed)
+    return np.fromiter((rng.randint(0, 2 ** 64 - 1) for _ in range(amount)),
+                       dtype=np.uint64, count=amount)
+
 
-    return hamming_distances
+def hamming_histogram(nums, block_size=BLOCK_SIZE):
+    """Return the number of pairs of nums at each Hamming distance 0-64.
+
+    Pairs are XORed a block x block tile at a time, so memory use does not
+    grow with the amount of numbers.
+    """
+    histogram = np.zeros(BINS, dtype=np.int64)
+    for start in range(0, len(nums), block_size):
+        rows = nums[start:start + block_size, np.newaxis]
+        for col_start in range(start, len(nums), block_size):
+            cols = nums[col_start:col_start + block_size]
+            distances = popcount(rows ^ cols)
+            if col_start == start:
+                # Diagonal tile: keep each pair once and skip self pairs
+                distances = distances[np.triu_indices(len(cols), 1,
+                                                      len(cols))]
+            histogram += np.bincount(distances.ravel(), minlength=BINS)
+    return histogram
+
+
+def histogram_mean(histogram):
+    return (np.arange(BINS) * histogram).sum() / histogram.sum()
+
+
+def histogram_variance(histogram):
+    deviations = np.arange(BINS) - histogram_mean(histogram)
+    return (histogram * deviations ** 2).sum() / histogram.sum()
+
+
+def seed_stats(seed, amount=NUMBERS_PER_SEED):
+    """Return (seed, histogram, mean, variance) for one seed. Only the
+    fixed size histogram is sent back from a worker process.
+    """
+    histogram = hamming_histogram(random_numbers(seed, amount))
+    return (seed, histogram, histogram_mean(histogram),
+            histogram_variance(histogram))
 
 
-if len(sys.argv) > 1:
-    start_seed = int(sys.argv[1])
-else:
-    start_seed = 100
+def merge_stats(total, count, mean, variance):
+    """Combine running (count, mean, sum of squared deviations) with the
+    statistics of another group of samples (Chan et al.).
+    """
+    total_count, total_mean, total_m2 = total
+    merged_count = total_count + count
+    delta = mean - total_mean
+    merged_mean = total_mean + delta * count / merged_count
+    merged_m2 = (total_m2 + variance * count
+                 + delta ** 2 * total_count * count / merged_count)
+    return merged_count, merged_mean, merged_m2
+
+
+def sweep(seeds, amount=NUMBERS_PER_SEED, workers=None):
+    """Yield seed_stats() for each seed, in order, as worker processes
+    (default: one per CPU) finish them.
+    """
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        chunksize = max(1, len(seeds) // (4 * (workers or os.cpu_count())))
+        yield from pool.map(seed_stats, seeds, [amount] * len(seeds),
+                            chunksize=chunksize)
+
+
+def write_sweep(seeds, amount=NUMBERS_PER_SEED, workers=None, output=None,
+                keep=()):
+    """Write one row of statistics per seed to output (default: stdout)
+    as results arrive, then print the statistics of the whole sweep.
+    Return the histograms of the seeds in keep.
+    """
+    out = open(output, 'w', newline='') if output else sys.stdout
+    writer = csv.writer(out, delimiter=',' if output else '\t')
+    writer.writerow(('seed', 'pairs', 'mean', 'variance', 'equal_pairs'))
+    total = (0, 0.0, 0.0)
+    combined = np.zeros(BINS, dtype=np.int64)
+    lowest = highest = None
+    kept = {}
+    try:
+        for seed, histogram, mean, variance in sweep(seeds, amount, workers):
+            pairs = int(histogram.sum())
+            writer.writerow((seed, pairs, f'{mean:.6f}', f'{variance:.6f}',
+                             histogram[0]))
+            total = merge_stats(total, pairs, mean, variance)
+            combined += histogram
+            perf.count('seeds')
+            perf.count('pairs', pairs)
+            lowest = min(lowest or (mean, seed), (mean, seed))
+            highest = max(highest or (mean, seed), (mean, seed))
+            if seed in keep:
+                kept[seed] = histogram
+    finally:
+        if output:
+            out.close()
+
+    count, mean, m2 = total
+    print(f'{len(seeds)} seeds, {count} pairs: mean={mean:.6f} '
+          f'variance={m2 / count:.6f} (expected 32, 16), '
+          f'{combined[0]} equal pairs', file=sys.stderr)
+    print(f'lowest mean {lowest[0]:.6f} (seed {lowest[1]}), '
+          f'highest {highest[0]:.6f} (seed {highest[1]})', file=sys.stderr)
+    return kept
+
+
+def plot_histograms(histograms):
+    """Plot up to 8 seed: histogram items in a 2 x 4 grid."""
+    import matplotlib.pyplot as plt
+    fig, axs = plt.subplots(2, 4, figsize=(8, 5))
+    for ax, (seed, histogram) in zip(axs.flat, histograms.items()):
+        ax.stairs(histogram, np.arange(BINS + 1) - 0.5, fill=True)
+        avg = histogram_mean(histogram)
+        ax.axvline(avg, color='red', linewidth=1.5)
+        ax.set_title('Seed {}, avg={:.5}'.format(seed, avg), size='medium')
+
+    fig.suptitle('Hamming Distance Histograms for Pseudorandom Integers')
+    plt.tight_layout()
+    plt.show()
+
+
+def int_at_least(minimum):
+    """argparse type for an int no smaller than minimum."""
+    def parse(text):
+        value = int(text)
+        if value < minimum:
+            raise argparse.ArgumentTypeError(f'must be at least {minimum}')
+        return value
+    return parse
+
+
+def find_hamming_distances(seed, amount=NUMBERS_PER_SEED):
+    """Return a histogram of Hamming distances for all pairs of 64 bit
+    pseudorandom numbers, indexed by distance.
+    """
+    print(f'Calculating seed {seed}...')
+    histogram = hamming_histogram(random_numbers(seed, amount))
+    perf.count('seeds')
+    perf.count('pairs', int(histogram.sum()))
+    if histogram[0]:
+        print(f'xor to 0: {histogram[0]} pairs of equal numbers')
+    return histogram
+
 
-seeds = list(range(start_seed, start_seed + 8))
-fig, axs = plt.subplots(2, 4, figsize=(8, 5))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Hamming distances between pseudorandom integers.')
+    parser.add_argument('start_seed', type=int, nargs='?', default=100)
+    parser.add_argument('amount', type=int_at_least(2), nargs='?',
+                        default=NUMBERS_PER_SEED,
+                        help='numbers generated per seed (at least 2)')
+    parser.add_argument('--seeds', type=int_at_least(1),
+                        help='sweep this many consecutive seeds')
+    parser.add_argument('--workers', type=int_at_least(1),
+                        default=os.cpu_count(),
+                        help='worker processes for --seeds')
+    parser.add_argument('--output', help='write the sweep table as CSV')
+    parser.add_argument('--plot', type=int, nargs='*', metavar='SEED',
+                        help='plot these seeds of the sweep (default: first 8)')
+    perf.add_report_arguments(parser)
+    args = parser.parse_args()
+    report = perf.Report('hamming_distance_by_seed', args.trace_memory,
+                         vars(args))
 
-for i in range(8):
-    if i < 4:
-        ax = axs[0, i]
+    if args.seeds is None:
+        seeds = range(args.start_seed, args.start_seed + 8)
+        with report.measure('find_hamming_distances'):
+            histograms = {seed: find_hamming_distances(seed, args.amount)
+                          for seed in seeds}
     else:
-        ax = axs[1, i - 4]
-    hamming_distances = find_hamming_distances(seeds[i])
-    ax.hist(hamming_distances)
-    avg = sum(hamming_distances) / len(hamming_distances)
-    ax.axvline(avg, color='red', linewidth=1.5)
-    ax.set_title('Seed {}, avg={:.5}'.format(seeds[i], avg), size='medium')
-
-fig.suptitle('Hamming Distance Histograms for Pseudorandom Integers')
-plt.tight_layout()
-plt.show()
+        seeds = range(args.start_seed, args.start_seed + args.seeds)
+        keep = ()
+        if args.plot is not None:
+            keep = set((args.plot or seeds)[:8])
+        with report.measure('write_sweep'):
+            histograms = dict(sorted(write_sweep(
+                seeds, args.amount, args.workers, args.output, keep).items()))
+    if args.report:
+        report.write(args.report)
+    if histograms:
+        plot_histograms(histograms)
@@ -0,0 +1,174 @@
+"""
+Benchmark json_parser against the standard library json module on
+synthetic corpora of different shapes.
+
+Use: python bench.py [--size MB] [--repeat N] [--output results.json]
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import json_parser
+
+# Characters used for generated keys and strings
+LETTERS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+def random_word(rng, length):
+    return "".join(rng.choice(LETTERS) for _ in range(length))
+
+def deep_nesting(rng, size):
+    # Objects and arrays nested 100 levels deep, repeated to fill 'size'
+    depth = 100
+    record = '{"a":[' * depth + str(rng.randint(0, 99)) + "]}" * depth
+    return "[" + ",".join([record] * max(1, size // (len(record) + 1))) + "]"
+
+def long_strings(rng, size):
+    # Kilobyte strings with backslash escapes and \u sequences
+    escapes = ['\\"', "\\\\", "\\/", "\\n", "\\t", "\\u00e9", "\\u4e2d", "\\u0ab4"]
+    strings = []
+    total = 0
+    while total < size:
+        parts = [random_word(rng, rng.randint(1, 20)) + rng.choice(escapes)
+                 for _ in range(80)]
+        strings.append('"' + "".join(parts) + '"')
+        total += len(strings[-1]) + 1
+    return "[" + ",".join(strings) + "]"
+
+def number_arrays(rng, size):
+    # Arrays of ints, negative floats and exponents
+    numbers = []
+    total = 0
+    while total < size:
+        numbers.append(rng.choice((str(rng.randint(0, 10 ** 9)),
+                                   f"{rng.uniform(-1e6, 1e6):.6f}",
+                                   f"{rng.uniform(1, 10):.3f}e-{rng.randint(1, 20)}")))
+        total += len(numbers[-1]) + 1
+    rows = [numbers[i:i + 1000] for i in range(0, len(numbers), 1000)]
+    return "[" + ",".join("[" + ",".join(row) + "]" for row in rows) + "]"
+
+def wide_objects(rng, size):
+    # Objects with 1000 keys each, with string, number, literal values
+    keys = [random_word(rng, 12) for _ in range(1000)]
+    values = ('"' + random_word(rng, 8) + '"', "12345", "true", "null", "-0.5")
+    objs = []
+    total = 0
+    while total < size:
+        objs.append("{" + ",".join(f'"{key}":{rng.choice(values)}'
+                                   for key in keys) + "}")
+        total += len(objs[-1]) + 1
+    return "[" + ",".join(objs) + "]"
+
+def api_records(rng, size):
+    # Typical API dump: an object holding a long array of small records
+    records = []
+    total = 0
+    while total < size:
+        records.append(json.dumps({
+            "agentSymbol": random_word(rng, 10),
+            "credits": rng.randint(0, 10 ** 8),
+            "ratio": rng.random(),
+            "active": rng.random() < 0.5,
+            "tags": [random_word(rng, 5) for _ in range(3)],
+            "home": {"system": random_word(rng, 6), "x": rng.randint(-500, 500)},
+        }))
+        total += len(records[-1]) + 1
+    return '{"status":"ok","data":[' + ",".join(records) + "]}"
+
+CORPORA = {
+    "deep_nesting": deep_nesting,
+    "long_strings": long_strings,
+    "number_arrays": number_arrays,
+    "wide_objects": wide_objects,
+    "api_records": api_records,
+}
+
+def make_corpus(shape, size, seed=0):
+    """Return a JSON document of roughly 'size' bytes with the given shape,
+    one of CORPORA. The same seed always gives the same document.
+    """
+    return CORPORA[shape](random.Random(seed), size)
+
+def lex(json_text):
+    if json_parser.parse_funcs is not None:
+        return json_parser.parse_funcs.lex_tokens(json_text, False)
+    return json_parser.lex(json_text, None)
+
+TASKS = {
+    "lex": lex,
+    "parse": json_parser.parse,
+    "parse_fused": json_parser.parse_fused,
+    "stdlib_json": json.loads,
+}
+
+def best_time(func, arg, repeat):
+    # Lowest wall time of 'repeat' calls, the least noisy estimate
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def peak_memory(func, arg):
+    # Peak bytes allocated during one call, measured in a separate run
+    # because tracemalloc slows allocation down
+    tracemalloc.start()
+    try:
+        func(arg)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run(size, repeat, shapes=None, tasks=None):
+    """Benchmark every task on every corpus shape and return a list of
+    result dicts.
+    """
+    results = []
+    for shape in shapes or CORPORA:
+        corpus = make_corpus(shape, size)
+        size_mb = len(corpus.encode("utf-8")) / 1e6
+        for task in tasks or TASKS:
+            seconds = best_time(TASKS[task], corpus, repeat)
+            results.append({
+                "corpus": shape,
+                "task": task,
+                "mb": round(size_mb, 3),
+                "seconds": seconds,
+                "mb_per_s": size_mb / seconds,
+                "peak_mb": peak_memory(TASKS[task], corpus) / 1e6,
+            })
+    return results
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument("--size", type=float, default=2.0,
+                            help="corpus size in MB (default: 2)")
+    arg_parser.add_argument("--repeat", type=int, default=3,
+                            help="timed runs per task, best is kept (default: 3)")
+    arg_parser.add_argument("--corpus", action="append", choices=CORPORA,
+                            help="corpus shape to run, may be repeated (default: all)")
+    arg_parser.add_argument("--task", action="append", choices=TASKS,
+                            help="task to run, may be repeated (default: all)")
+    arg_parser.add_argument("--output", help="write results as JSON to this file")
+    args = arg_parser.parse_args()
+    # parse() recurses once per nesting level
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+
+    results = run(int(args.size * 1e6), args.repeat, args.corpus, args.task)
+    print(f"{'corpus':<15}{'task':<13}{'MB':>8}{'MB/s':>10}{'peak MB':>10}")
+    for result in results:
+        print(f"{result['corpus']:<15}{result['task']:<13}{result['mb']:>8.2f}"
+              f"{result['mb_per_s']:>10.2f}{result['peak_mb']:>10.1f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "native_lexer": json_parser.parse_funcs is not None,
+                "size": args.size,
+                "repeat": args.repeat,
+                "results": results,
+            }, f, indent=2)
@@ -2,16 +2,142 @@
 Convert a JSON file to a Python object.
 
 Use: python json_parser.py json_file.txt
+     python json_parser.py --stream json_file.txt
+     python json_parser.py --mmap json_file.txt
+     python json_parser.py --lines [--workers N] json_lines_file.txt
+     python json_parser.py --stats|--profile [--python-lexer] json_file.txt
+     python json_parser.py --cache [--cache-dir DIR] json_file.txt
+     python json_parser.py --report report.json [--trace-memory] json_file.txt
 """
+import argparse
+import array
+import collections
+import concurrent.futures
 import cProfile
+import ctypes
+import hashlib
+import io
+import itertools
+import mmap
+import os
+import pickle
+import pstats
+import re
 import sys
 import time
-import ctypes
+import tracemalloc
+import types
+
+# Build with the command in gcc.txt. Without the shared library, lexing falls
+# back to pure Python.
+try:
+    # PyDLL holds the GIL, which lex_tokens() needs to build Python objects
+    parse_funcs = ctypes.PyDLL(os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), 'parse_funcs.so'))
+    parse_funcs.lex_tokens.argtypes = [ctypes.py_object, ctypes.c_int]
+    parse_funcs.lex_tokens.restype = ctypes.py_object
+    parse_funcs.set_structural_tokens.argtypes = [ctypes.py_object]
+    parse_funcs.set_structural_tokens.restype = ctypes.c_int
+    parse_funcs.structural_index.argtypes = [ctypes.py_object]
+    parse_funcs.structural_index.restype = ctypes.py_object
+except OSError:
+    parse_funcs = None
+# parse() uses lex_tokens() when it is available and this is set
+use_native_lexer = True
+
+class Structural(str):
+    # Token for one of {}[]:, from lex() or lex_tokens(). It compares equal
+    # to the character, but parse_obj() and parse_array() tell it apart
+    # from a string token with the same text, such as "{", by identity.
+    __slots__ = ()
+
+STRUCTURAL_TOKENS = {char: Structural(char) for char in "{}[]:,"}
+LBRACE, RBRACE, LBRACKET, RBRACKET, COLON, COMMA = STRUCTURAL_TOKENS.values()
+if parse_funcs is not None:
+    parse_funcs.set_structural_tokens(tuple(STRUCTURAL_TOKENS.values()))
+
+# Characters read per file.read() call when streaming
+CHUNK_SIZE = 1 << 16
+# Bytes of JSON Lines input given to a worker process at a time
+LINES_BATCH_SIZE = 1 << 20
+# Default memory budget of a ParseCache, counted in bytes of source JSON
+PARSE_CACHE_BYTES = 64 << 20
+# Every character that can occur in a JSON number
+NUM_CHARS = re.compile(r"[-+0-9.eE]*")
+LITERALS = (("true", True), ("null", None), ("false", False))
+ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n",
+           "r": "\r", "t": "\t"}
+HEX_DIGITS = "0123456789abcdefABCDEF"
+# Groups: fraction, exponent
+NUMBER = re.compile(r"-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?")
+# One match per backslash escape in a JSON string
+ESCAPE = re.compile(r"\\(u[0-9a-fA-F]{4}|.)", re.S)
+UTF8_ESCAPE = re.compile(rb"\\(u[0-9a-fA-F]{4}|.)", re.S)
+# Whole strings are matched so that their contents are skipped
+STRUCTURALS = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]:,]')
+UTF8_STRUCTURALS = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\]:,]')
+
+def lex_string(json, i):
+    """Lex the string whose opening quotation mark is at json[i]. Return the
+    unescaped string and the index just past its closing quotation mark.
+    Raises IndexError if json ends before the string does.
+    """
+    i += 1
+    end = json.find('"', i)
+    if end < 0:
+        raise IndexError("unterminated string")
+    if json.find("\\", i, end) < 0:
+        return json[i:end], end + 1
 
-parse_funcs = ctypes.CDLL('./parse_funcs.so')
+    pieces = []
+    while True:
+        quote = json.find('"', i)
+        backslash = json.find("\\", i, quote)
+        if quote < 0:
+            raise IndexError("unterminated string")
+        elif backslash < 0:
+            pieces.append(json[i:quote])
+            return "".join(pieces), quote + 1
+        pieces.append(json[i:backslash])
+        char = json[backslash + 1]
+        if char == "u":
+            hex_digits = json[backslash + 2:backslash + 6]
+            if len(hex_digits) < 4:
+                raise IndexError("unterminated string")
+            if hex_digits.strip(HEX_DIGITS):
+                raise ValueError('invalid escaped Unicode:',
+                                 f'{json[backslash:backslash + 6]}')
+            pieces.append(chr(int(hex_digits, 16)))
+            i = backslash + 6
+        elif char in ESCAPES:
+            pieces.append(ESCAPES[char])
+            i = backslash + 2
+        else:
+            raise ValueError("backslash followed by invalid",
+                             f"character: {char}")
+
+def scan_number(json, i):
+    """Return the index past the number starting at json[i]. Raise
+    ValueError with the messages of scan_number() in parse_funcs.c.
+    """
+    match = NUMBER.match(json, i)
+    if match is None:
+        raise ValueError("minus sign not followed by digits")
+    end = match.end()
+    # NUMBER stops before the part of a number that is invalid
+    fraction, exponent = match.groups()
+    following = json[end:end + 1]
+    if "0" <= following <= "9":
+        raise ValueError("JSON numbers cannot have leading zeroes")
+    if following == "." and fraction is None and exponent is None:
+        raise ValueError("decimal point not followed by digits")
+    if following in ("e", "E") and exponent is None:
+        raise ValueError("exponent not followed by digits")
+    return end
 
-def lex(json, wchar_json):
-    # Convert a JSON string to a 'tokens' iterable
+def lex(json, wchar_json, ints=False, stats=None):
+    # Convert a JSON string to a 'tokens' iterable. wchar_json is no longer
+    # used and is kept for existing callers.
     if json[0] == "{" and json[-1] == "}":
         pass
     elif json[0] == "[" and json[-1] == "]":
@@ -22,72 +148,12 @@ def lex(json, wchar_json):
     i = 0
     tokens = []
     while i < len(json):
-        orig_i = i
         if json[i] in "[]{}:,":
-            tokens.append(json[i])
+            tokens.append(STRUCTURAL_TOKENS[json[i]])
             i += 1
         elif json[i] == '"':
-            # TODO: refactor lexing escape characters
-            paired_backslash = None
-            remove_indexes = []
-            i += 1
-            appended = False
-            # The outer loop ignores any escaped "
-            while True:
-                while json[i] != '"':
-                    if json[i] == "\\":
-                        if paired_backslash is None:
-                            paired_backslash = False
-                        else:
-                            paired_backslash ^= True
-                        if json[i + 1] not in '"\\/bfnrtu' and not paired_backslash:
-                            raise ValueError("backslash followed by invalid",
-                                             f"character: {json[i + 1]}")
-                        if json[i + 1] == 'u':
-                            for j in range(2, 6):
-                                if json[i + j].lower() not in 'abcdef0123456789':
-                                    raise ValueError('invalid escaped Unicode:',
-                                                     f'{json[i:i+6]}')
-                        if not paired_backslash:
-                            remove_indexes.append(i)
-                    elif paired_backslash is False:
-                       paired_backslash = True
-                    i += 1
-                assert json[i] == '"'
-                # Append token when an unescaped quotation mark is found
-                if json[i-1] != "\\" or paired_backslash:
-                    token = json[orig_i + 1:i]
-                    if remove_indexes:
-                        token = list(token)
-                        # zip() probably has a higher runtime cost
-                        control_chars = (('b', '\b'), ('f', '\f'), ('n', '\n'),
-                                         ('r', '\r'), ('t', '\t'))
-                    for idx in remove_indexes[::-1]:
-                        if json[idx + 1] in '"/\\':
-                            # orig_i is index of initial ", orig_i + 1 index is \
-                            del token[idx - (orig_i + 1)]
-                            continue
-                        elif json[idx + 1] == 'u':
-                            adj_idx = idx - (orig_i + 1)
-                            hex_digits = ''.join(token[adj_idx + 2:adj_idx + 6])
-                            unicode_char = chr(int(hex_digits, 16))
-                            token[adj_idx] = unicode_char
-                            del token[adj_idx + 1:adj_idx + 6]
-                            continue
-
-                        for letter, control_char in control_chars:
-                            if json[idx + 1] == letter:
-                                token[idx - orig_i] = control_char
-                                del token[idx - (orig_i + 1)]
-                                break
-
-                    if isinstance(token, list):
-                        token = ''.join(token)
-                    tokens.append(token)
-                    appended = True
-                i += 1
-                if appended:
-                    break
+            token, i = lex_string(json, i)
+            tokens.append(token)
         elif json[i].isalpha():
             if json[i:i + 4] == "true":
                 i += 4
@@ -101,9 +167,18 @@ def lex(json, wchar_json):
             else:
                 raise ValueError(f"""invalid string is missing quotation marks:
                                  {json[i:i+10]}""")
-        elif json[i].isdigit() or (json[i] == "-" and json[i + 1].isdigit()):
-            end_i = parse_funcs.lex_num(i, wchar_json, len(json))
-            tokens.append(float(json[i:end_i]))
+        elif "0" <= json[i] <= "9" or json[i] == "-":
+            if stats is None:
+                end_i = scan_number(json, i)
+            else:
+                start = time.perf_counter()
+                end_i = scan_number(json, i)
+                stats["lex_num_seconds"] += time.perf_counter() - start
+                stats["lex_num_calls"] += 1
+            if ints and json[i:end_i].lstrip("-").isdigit():
+                tokens.append(int(json[i:end_i]))
+            else:
+                tokens.append(float(json[i:end_i]))
             i = end_i
         elif json[i].strip() == "":
             i += 1
@@ -112,98 +187,971 @@ def lex(json, wchar_json):
 
     return tokens
 
-def parse_array(i, tokens):
+def numeric_array(values, kind):
+    """Pack a list of numbers into an array.array ('q' if every value is an
+    int that fits, else 'd') or, with kind "numpy", a NumPy array. Lists that
+    hold anything else, or ints that would lose precision as int64 or
+    float64 values, are returned unchanged.
+    """
+    if not values:
+        return values
+    all_ints = True
+    for value in values:
+        if type(value) is int:
+            continue
+        if type(value) is not float:
+            return values
+        all_ints = False
+    if all_ints:
+        if min(values) < -(1 << 63) or max(values) >= 1 << 63:
+            return values
+        typecode, dtype = "q", "int64"
+    else:
+        # Ints above 2 ** 53 are not all exact as doubles
+        for value in values:
+            if type(value) is int and abs(value) > 1 << 53:
+                return values
+        typecode, dtype = "d", "float64"
+    if kind == "numpy":
+        import numpy
+        return numpy.array(values, dtype=dtype)
+    return array.array(typecode, values)
+
+def parse_array(i, tokens, keys=None, numeric=None):
     # Convert the 'tokens' iterable to Python object
     values = []
     while i < len(tokens):
+        token = tokens[i]
         # Do not increment i here, increment at end of the parse_obj() loop
-        if tokens[i] == "]":
+        if token is RBRACKET:
+            if numeric is not None:
+                values = numeric_array(values, numeric)
             return i, values
-        elif tokens[i] == "{":
-            i, obj = parse_obj(tokens, i + 1)
+        elif token is LBRACE:
+            i, obj = parse_obj(tokens, i + 1, keys, numeric)
             values.append(obj)
-        elif tokens[i] == "[":
-            i, arr = parse_array(i + 1, tokens)
+        elif token is LBRACKET:
+            i, arr = parse_array(i + 1, tokens, keys, numeric)
             values.append(arr)
-        elif tokens[i] != ",":
-            values.append(tokens[i])
-            if tokens[i + 1] != "," and tokens[i + 1] != "]":
-                raise ValueError(
-                        "parse_array() did not find delimiter or end of array"
-                )
+            # parse_array() returns the index of its closing bracket
             i += 1
-        elif tokens[i] == ",":
-            if tokens[i + 1] == "]":
+        elif token is COMMA:
+            if tokens[i + 1] is RBRACKET:
                 raise ValueError("JSON spec disallows trailing comma in arrays")
             i += 1
+        elif type(token) is Structural:
+            raise ValueError("unexpected value:", token)
         else:
-            raise ValueError("unexpected value:", tokens[i])
+            values.append(token)
+            if tokens[i + 1] is not COMMA and tokens[i + 1] is not RBRACKET:
+                raise ValueError(
+                        "parse_array() did not find delimiter or end of array"
+                )
+            i += 1
 
     if i >= len(tokens):
         raise ValueError("parse_array() did not find end of array")
 
-def parse_obj(tokens, i=1):
+def parse_obj(tokens, i=1, keys=None, numeric=None):
+    # 'keys' caches one str per distinct key, shared by every object
     obj = {}
     key = ""
     while i < len(tokens):
         token = tokens[i]
-        if token == "{":
-            i, child_obj = parse_obj(tokens, i + 1)
+        if token is LBRACE:
+            i, child_obj = parse_obj(tokens, i + 1, keys, numeric)
             assert key
             obj[key] = child_obj
             key = ""
-        elif token == "}":
+            # parse_obj() returns the index after its closing brace
+            continue
+        elif token is RBRACE:
             return i + 1, obj
-        elif token == "[":
-            i, arr = parse_array(i + 1, tokens)
+        elif token is LBRACKET:
+            i, arr = parse_array(i + 1, tokens, keys, numeric)
             assert key
             obj[key] = arr
             key = ""
-        elif token == ":":
+        elif token is COLON:
             assert key
-        elif token == ",":
+        elif token is COMMA:
             assert key == ""
+        elif type(token) is Structural:
+            raise ValueError("unexpected value:", token)
         elif token in (None, True, False):
             assert key
             obj[key] = token
             key = ""
         else:
             if key == "":
-                key = token
+                key = token if keys is None else keys.setdefault(token, token)
             else:
                 obj[key] = token
                 key = ""
         i += 1
     return i, obj
 
-def parse(json):
-    wchar_json = ctypes.c_wchar_p(json)
-    tokens = lex(json, wchar_json)
-    if tokens[0] == "{":
-        return parse_obj(tokens)
-    elif tokens[0] == "[":
-        return parse_array(1, tokens)
-    raise ValueError(f"""invalid JSON beginning or end char: begin={tokens[0]},
-                     end={tokens[-1]}""")
+def token_stats(stats, tokens, json):
+    # Count tokens by type, with each structural character counted apart
+    counts = collections.Counter()
+    for token in tokens:
+        if type(token) is Structural:
+            counts[token] += 1
+        else:
+            counts[type(token).__name__] += 1
+    stats["tokens"] = dict(counts)
+    escapes = (ESCAPE if isinstance(json, str) else UTF8_ESCAPE).findall(json)
+    stats["escapes"] = len(escapes)
+    stats["unicode_escapes"] = sum(len(escape) > 1 for escape in escapes)
+
+def parse(json, ints=False, intern_keys=False, numeric_arrays=None,
+          stats=None):
+    """Convert JSON (a str or UTF-8 bytes, memoryview or mmap) to a Python
+    object. Return the index after the last token used and the object.
+
+    ints: return integral numbers as exact ints instead of floats
+    intern_keys: share one str per distinct object key across the document
+    numeric_arrays: "array" or "numpy" to return arrays holding only numbers
+        as array.array or NumPy arrays instead of lists
+    stats: a dict to fill with per-phase wall times in seconds (lexing, the
+        number scanning of the Python lexer, tree building), token
+        counts by type and escape counts. If tracemalloc is tracing, the
+        peak traced memory in bytes is added as "peak_memory".
+    """
+    if stats is not None:
+        native = parse_funcs is not None and use_native_lexer
+        stats.update(lexer="native" if native else "python",
+                     lex_num_calls=0, lex_num_seconds=0.0)
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+    if parse_funcs is not None and use_native_lexer:
+        # Native tokenizer, see lex_tokens() in parse_funcs.c. Buffers are
+        # lexed in place and only string tokens are decoded.
+        tokens = parse_funcs.lex_tokens(json, ints)
+    else:
+        if not isinstance(json, str):
+            json = str(json, "utf-8").strip()
+        tokens = lex(json, None, ints, stats)
+    if stats is not None:
+        lexed = time.perf_counter()
+    keys = {} if intern_keys else None
+    if tokens[0] is LBRACE:
+        result = parse_obj(tokens, 1, keys, numeric_arrays)
+    elif tokens[0] is LBRACKET:
+        result = parse_array(1, tokens, keys, numeric_arrays)
+    else:
+        raise ValueError(f"""invalid JSON beginning or end char: begin={tokens[0]},
+                         end={tokens[-1]}""")
+    if stats is not None:
+        stats["lex_seconds"] = lexed - start
+        stats["build_seconds"] = time.perf_counter() - lexed
+        if tracemalloc.is_tracing():
+            stats["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        token_stats(stats, tokens, json)
+    return result
+
+def freeze(obj):
+    # Read-only copy of a parsed value: dicts become mappingproxy, lists and
+    # array.array tuples, and NumPy arrays are made read-only in place
+    if type(obj) is dict:
+        return types.MappingProxyType({key: freeze(value) for key, value in obj.items()})
+    elif type(obj) is list or type(obj) is array.array:
+        return tuple(freeze(value) for value in obj)
+    elif type(obj).__name__ == "ndarray":
+        obj.flags.writeable = False
+    return obj
+
+class ParseCache:
+    """Cache of parse() results keyed by a hash of the JSON content (and
+    the parse options). Entries are evicted least recently used first once
+    their source JSON adds up to more than max_bytes. With a directory,
+    results are also pickled to disk and survive the process.
+
+    With frozen=True (the default) results are returned as read-only
+    mappingproxy/tuple trees, with numeric_arrays as tuples or read-only
+    NumPy arrays, so every hit can safely share one object.
+    With frozen=False the shared result is returned as is and callers must
+    not modify it.
+    """
+
+    def __init__(self, max_bytes=PARSE_CACHE_BYTES, directory=None, frozen=True):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.frozen = frozen
+        # key -> (result, size of its source JSON)
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        # (path, options) -> (mtime_ns, size, key), so unchanged files are
+        # not read again to be hashed
+        self.paths = {}
+        self.hits = self.disk_hits = self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, data, options):
+        digest = hashlib.blake2b(data, digest_size=16)
+        digest.update(repr(sorted(options.items())).encode())
+        return digest.hexdigest()
+
+    def parse(self, json, **options):
+        """Return parse(json, **options), from the cache if possible."""
+        data = json.encode("utf-8") if isinstance(json, str) else json
+        key = self.key(data, options)
+        return self.lookup(key, len(data), lambda: parse(json, **options))
+
+    def parse_file(self, path, **options):
+        """Return parse() of the file at path. A file whose modification
+        time and size are unchanged since the last call is not read again.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        path_key = (path, tuple(sorted(options.items())))
+        known = self.paths.get(path_key)
+        if known is not None and known[:2] == (stat.st_mtime_ns, stat.st_size) \
+                and known[2] in self.entries:
+            return self.lookup(known[2], stat.st_size, None)
+        with open(path, "rb") as f:
+            data = f.read()
+        key = self.key(data, options)
+        self.paths[path_key] = (stat.st_mtime_ns, stat.st_size, key)
+        return self.lookup(key, len(data), lambda: parse(data, **options))
+
+    def lookup(self, key, size, compute):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        result = self.load(key)
+        if result is None:
+            self.misses += 1
+            result = compute()
+            self.save(key, result)
+        else:
+            self.disk_hits += 1
+        if self.frozen:
+            result = (result[0], freeze(result[1]))
+        self.entries[key] = (result, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+        return result
+
+    def load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(os.path.join(self.directory, key + ".pickle"), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, key, result):
+        if self.directory is None:
+            return
+        path = os.path.join(self.directory, key + ".pickle")
+        # Write then rename, so a reader never sees a partial file
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+    def clear(self):
+        self.entries.clear()
+        self.paths.clear()
+        self.size = 0
+
+def parse_fused(json):
+    """Lex and build the Python object in a single loop, without a token
+    list. Open objects and arrays are kept on an explicit stack instead of
+    the call stack, so nesting depth is limited only by memory. Returns the
+    object itself, not an (index, object) pair like parse().
+    """
+    if not isinstance(json, str):
+        json = str(json, "utf-8")
+    # What the next non-whitespace character may be
+    VALUE, FIRST_VALUE, KEY, FIRST_KEY, COLON, NEXT, DONE = range(7)
+    state = VALUE
+    stack = []
+    key = None
+    root = None
+    i = 0
+    length = len(json)
+    try:
+        while i < length:
+            char = json[i]
+            if char in " \t\n\r":
+                i += 1
+                continue
+            if state == NEXT:
+                is_obj = type(stack[-1]) is dict
+                if char == ",":
+                    state = KEY if is_obj else VALUE
+                elif char == ("}" if is_obj else "]"):
+                    stack.pop()
+                    state = NEXT if stack else DONE
+                else:
+                    raise ValueError(f"expected comma or end of {'object' if is_obj else 'array'}"
+                                     f" at index {i}: '{json[i:i+10]}'")
+                i += 1
+                continue
+            elif state == COLON:
+                if char != ":":
+                    raise ValueError(f"object key not followed by colon at index {i}")
+                state = VALUE
+                i += 1
+                continue
+            elif state == KEY or state == FIRST_KEY:
+                if char == '"':
+                    key, i = lex_string(json, i)
+                    state = COLON
+                    continue
+                elif char == "}" and state == FIRST_KEY:
+                    stack.pop()
+                    state = NEXT if stack else DONE
+                    i += 1
+                    continue
+                raise ValueError(f"object key must be a string at index {i}: '{json[i:i+10]}'")
+            elif state == DONE:
+                raise ValueError(f"unexpected data after end of JSON at index {i}")
+            elif char == "]" and state == FIRST_VALUE:
+                stack.pop()
+                state = NEXT if stack else DONE
+                i += 1
+                continue
+
+            if char == "{":
+                value = {}
+                i += 1
+            elif char == "[":
+                value = []
+                i += 1
+            elif char == '"':
+                value, i = lex_string(json, i)
+            elif char == "-" or "0" <= char <= "9":
+                match = NUMBER.match(json, i)
+                if match is None:
+                    raise ValueError(f"invalid number at index {i}: '{json[i:i+10]}'")
+                value = float(match.group())
+                i = match.end()
+            else:
+                for literal, value in LITERALS:
+                    if json.startswith(literal, i):
+                        i += len(literal)
+                        break
+                else:
+                    raise ValueError(f"unexpected character={char} in '{json[i:i+10]}'")
+
+            if not stack:
+                if type(value) is not dict and type(value) is not list:
+                    raise ValueError("JSON must begin with a curly brace or bracket")
+                root = value
+            elif type(stack[-1]) is list:
+                stack[-1].append(value)
+            else:
+                stack[-1][key] = value
+            if char == "{":
+                stack.append(value)
+                state = FIRST_KEY
+            elif char == "[":
+                stack.append(value)
+                state = FIRST_VALUE
+            else:
+                state = NEXT
+    except IndexError:
+        # lex_string() ran off the end of an unterminated string
+        pass
+    if state != DONE:
+        raise ValueError("unexpected end of JSON")
+    return root
+
+def parse_file(path, lazy=False):
+    """Parse a JSON file through a read-only mmap, so the document is never
+    copied into a str. With lazy=True, return the root of a LazyDocument
+    that keeps the mmap open for as long as it is referenced.
+    """
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if lazy:
+        return parse_lazy(mapped)
+    with mapped:
+        return parse(mapped)
+
+def line_ranges(path, batch_size=LINES_BATCH_SIZE):
+    # Split a file into (start, end) byte ranges of about batch_size bytes,
+    # each ending just after a newline or at the end of the file
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + batch_size, size) - 1)
+            f.readline()
+            end = min(f.tell(), size)
+            yield start, end
+            start = end
+
+def parse_line_range(path, start, end):
+    # Worker: parse each non-blank line of path[start:end]
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return [parse(line)[1] for line in data.splitlines() if line.strip()]
+
+def parse_batch(lines):
+    # Worker: parse a list of JSON documents
+    return [parse(line)[1] for line in lines if line.strip()]
+
+def ordered_map(func, jobs, workers):
+    """Run func(*job) for each job in a process pool, yielding results in
+    job order. At most 2 jobs per worker are in flight, so neither jobs nor
+    results pile up in memory.
+    """
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        yield from itertools.starmap(func, jobs)
+        return
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        for job in jobs:
+            pending.append(pool.submit(func, *job))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def parse_lines(path, batch_size=LINES_BATCH_SIZE, workers=None):
+    """Parse a JSON Lines (NDJSON) file in parallel and yield each record in
+    file order. The file is split on newlines into ranges of about
+    batch_size bytes, and each worker process reads and parses its own
+    ranges. workers defaults to the number of CPUs.
+    """
+    jobs = ((path, start, end) for start, end in line_ranges(path, batch_size))
+    for records in ordered_map(parse_line_range, jobs, workers):
+        yield from records
+
+def parse_many(documents, batch_size=1000, workers=None):
+    """Parse an iterable of JSON documents (str or bytes, e.g. the lines of
+    an open file) in parallel, batch_size documents per job, and yield the
+    results in order.
+    """
+    documents = iter(documents)
+    jobs = iter(lambda: (list(itertools.islice(documents, batch_size)),), ([],))
+    for objs in ordered_map(parse_batch, jobs, workers):
+        yield from objs
+
+def lex_stream(f, chunk_size=CHUNK_SIZE):
+    """Lex a JSON text file object chunk by chunk, yielding tokens as the
+    consumer asks for them. Only the unconsumed tail of the current chunk is
+    kept, so a token split across two chunks is lexed again after the next
+    read.
+    """
+    for _, token in lex_stream_kinds(f, chunk_size):
+        yield token
+
+def lex_stream_kinds(f, chunk_size=CHUNK_SIZE):
+    """Like lex_stream(), but yield (kind, token) pairs. kind is the token
+    itself for {}[]:, and otherwise "string", "number", "boolean" or "null",
+    so a string such as "{" can be told apart from a brace.
+    """
+    buf = f.read(chunk_size)
+    eof = not buf
+    i = 0
+    kind = token = None
+    while True:
+        if i >= len(buf):
+            if eof:
+                break
+            buf = f.read(chunk_size)
+            eof = not buf
+            i = 0
+            continue
+        try:
+            char = buf[i]
+            if char in "[]{}:,":
+                kind = token = char
+                i += 1
+            elif char == '"':
+                kind = "string"
+                token, i = lex_string(buf, i)
+            elif char.isalpha():
+                for literal, value in LITERALS:
+                    if buf.startswith(literal, i):
+                        kind = "null" if value is None else "boolean"
+                        token = value
+                        i += len(literal)
+                        break
+                else:
+                    if len(buf) - i < 5 and not eof:
+                        raise IndexError("literal split across chunks")
+                    raise ValueError(f"""invalid string is missing quotation marks:
+                                     {buf[i:i+10]}""")
+            elif "0" <= char <= "9" or char == "-":
+                if NUM_CHARS.match(buf, i).end() == len(buf) and not eof:
+                    raise IndexError("number split across chunks")
+                end_i = scan_number(buf, i)
+                kind = "number"
+                token = float(buf[i:end_i])
+                i = end_i
+            elif char.strip() == "":
+                i += 1
+                continue
+            else:
+                raise ValueError(f"unexpected character={char} in '{buf[i:i+10]}'")
+        except IndexError:
+            if eof:
+                raise ValueError(f"unexpected end of JSON: {buf[i:i+10]}")
+            # Keep the partial token and read at least as much again, so a
+            # token much longer than chunk_size is not rescanned per chunk.
+            chunk = f.read(max(chunk_size, len(buf) - i))
+            eof = not chunk
+            buf = buf[i:] + chunk
+            i = 0
+            continue
+        yield kind, token
+
+def parse_stream(f, chunk_size=CHUNK_SIZE):
+    """Convert a JSON text file object to a Python object without reading
+    the whole file or building a token list.
+    """
+    tokens = lex_stream_kinds(f, chunk_size)
+    try:
+        kind, token = next(tokens)
+        if kind != "{" and kind != "[":
+            raise ValueError(f"JSON must begin with a curly brace or bracket: {token}")
+        obj = parse_stream_value(kind, token, tokens)
+    except StopIteration:
+        raise ValueError("unexpected end of JSON") from None
+    for _, token in tokens:
+        raise ValueError(f"unexpected token after end of JSON: {token}")
+    return obj
+
+def parse_stream_value(kind, token, tokens):
+    # Build the value starting with 'token', pulling the rest of the
+    # (kind, token) pairs from 'tokens'. Branching on kind keeps a string
+    # such as "}" from being read as a brace.
+    if kind == "{":
+        obj = {}
+        kind, token = next(tokens)
+        if kind == "}":
+            return obj
+        while True:
+            if kind != "string":
+                raise ValueError(f"object key must be a string: {token}")
+            if next(tokens)[0] != ":":
+                raise ValueError(f"object key not followed by colon: {token}")
+            obj[token] = parse_stream_value(*next(tokens), tokens)
+            kind, token = next(tokens)
+            if kind == "}":
+                return obj
+            if kind != ",":
+                raise ValueError(f"expected comma or end of object: {token}")
+            kind, token = next(tokens)
+    elif kind == "[":
+        values = []
+        kind, token = next(tokens)
+        if kind == "]":
+            return values
+        while True:
+            values.append(parse_stream_value(kind, token, tokens))
+            kind, token = next(tokens)
+            if kind == "]":
+                return values
+            if kind != ",":
+                raise ValueError("parse_array() did not find delimiter or end of array")
+            kind, token = next(tokens)
+            if kind == "]":
+                raise ValueError("JSON spec disallows trailing comma in arrays")
+    elif kind in ("}", "]", ":", ","):
+        raise ValueError(f"unexpected token: {token}")
+    return token
+
+def iter_events(source, chunk_size=CHUNK_SIZE):
+    """Pull parser over a JSON text file object or str. Yield a
+    (path, event, value) triple per token, where event is one of start_map,
+    map_key, end_map, start_array, end_array, string, number, boolean or
+    null. path is the dot-joined list of keys leading to the value, with
+    "item" for each array level, e.g. "items.item.price". No Python objects
+    are built beyond the scalar values themselves.
+    """
+    if isinstance(source, str):
+        source = io.StringIO(source)
+    # What the next token may be, as in parse_fused()
+    VALUE, FIRST_VALUE, KEY, FIRST_KEY, COLON, NEXT, DONE = range(7)
+    state = VALUE
+    containers = []
+    container_paths = []
+    path = ""
+    for kind, token in lex_stream_kinds(source, chunk_size):
+        if state == NEXT:
+            is_obj = containers[-1] == "{"
+            if kind == ",":
+                state = KEY if is_obj else VALUE
+                continue
+            elif kind != ("}" if is_obj else "]"):
+                raise ValueError(f"expected comma or end of {'object' if is_obj else 'array'}:"
+                                 f" {token}")
+        elif state == COLON:
+            if kind != ":":
+                raise ValueError(f"object key not followed by colon: {token}")
+            state = VALUE
+            continue
+        elif state == KEY or state == FIRST_KEY:
+            if kind == "string":
+                parent = container_paths[-1]
+                yield parent, "map_key", token
+                path = f"{parent}.{token}" if parent else token
+                state = COLON
+                continue
+            elif kind != "}" or state == KEY:
+                raise ValueError(f"object key must be a string: {token}")
+        elif state == DONE:
+            raise ValueError(f"unexpected token after end of JSON: {token}")
+        elif kind == "]" and state == FIRST_VALUE:
+            pass
+        elif kind in ("}", "]", ":", ","):
+            raise ValueError(f"unexpected token: {token}")
+        elif not containers and kind != "{" and kind != "[":
+            raise ValueError(f"JSON must begin with a curly brace or bracket: {token}")
+
+        if kind == "{" or kind == "[":
+            yield path, "start_map" if kind == "{" else "start_array", None
+            containers.append(kind)
+            container_paths.append(path)
+            if kind == "{":
+                state = FIRST_KEY
+            else:
+                path = f"{path}.item" if path else "item"
+                state = FIRST_VALUE
+        elif kind == "}" or kind == "]":
+            containers.pop()
+            yield container_paths.pop(), "end_map" if kind == "}" else "end_array", None
+            if containers and containers[-1] == "[":
+                parent = container_paths[-1]
+                path = f"{parent}.item" if parent else "item"
+            state = NEXT if containers else DONE
+        else:
+            yield path, kind, token
+            state = NEXT
+    if state != DONE:
+        raise ValueError("unexpected end of JSON")
+
+def build_from_events(event, events):
+    # Build the object or array opened by 'event' from the rest of 'events'
+    root = {} if event == "start_map" else []
+    stack = [root]
+    key = None
+    for _, event, value in events:
+        if event == "map_key":
+            key = value
+            continue
+        elif event == "end_map" or event == "end_array":
+            stack.pop()
+            if not stack:
+                return root
+            continue
+        elif event == "start_map":
+            value = {}
+        elif event == "start_array":
+            value = []
+        if type(stack[-1]) is list:
+            stack[-1].append(value)
+        else:
+            stack[-1][key] = value
+        if event == "start_map" or event == "start_array":
+            stack.append(value)
+    raise ValueError("unexpected end of JSON")
+
+def items(source, prefix, chunk_size=CHUNK_SIZE):
+    """Yield every value found at path 'prefix' (see iter_events()), e.g.
+    items(f, "items.item.price"). Only the matching values are built, so
+    huge arrays can be aggregated in constant memory.
+    """
+    events = iter_events(source, chunk_size)
+    for path, event, value in events:
+        if path != prefix:
+            continue
+        if event == "start_map" or event == "start_array":
+            yield build_from_events(event, events)
+        elif event in ("string", "number", "boolean", "null"):
+            yield value
+
+def structural_index(json):
+    """Find every structural character of json in one pass. Return their
+    offsets, with strings recorded by their opening quotation mark, and for
+    each { or [ the index of its matching } or ] in the offsets (0 for every
+    other entry).
+    """
+    if parse_funcs is not None:
+        positions, closes = parse_funcs.structural_index(json)
+        return memoryview(positions).cast("q"), memoryview(closes).cast("q")
+    is_str = isinstance(json, str)
+    positions = array.array("q")
+    closes = array.array("q")
+    stack = []
+    for match in (STRUCTURALS if is_str else UTF8_STRUCTURALS).finditer(json):
+        char = json[match.start()]
+        if not is_str:
+            char = chr(char)
+        if char in "{[":
+            stack.append((len(positions), char))
+        elif char in "}]":
+            if not stack or "{[".index(stack[-1][1]) != "}]".index(char):
+                raise ValueError(f"unmatched {char} at index {match.start()}")
+            closes[stack.pop()[0]] = len(positions)
+        positions.append(match.start())
+        closes.append(0)
+    if stack:
+        raise ValueError("unclosed object or array")
+    if not positions:
+        raise ValueError("JSON has no object or array")
+    return positions, closes
+
+def parse_scalar(text):
+    # Convert the text of a number, true, false or null
+    for literal, value in LITERALS:
+        if text == literal:
+            return value
+    if not NUMBER.fullmatch(text):
+        raise ValueError(f"invalid value: '{text[:10]}'")
+    return float(text)
+
+class LazyDocument:
+    """A JSON document (str or UTF-8 bytes, memoryview or mmap) plus its
+    structural index. Values are decoded only when they are accessed through
+    the LazyObject and LazyArray views of the document.
+    """
+
+    def __init__(self, json):
+        self.json = json
+        self.positions, self.closes = structural_index(json)
+
+    def char(self, entry):
+        char = self.json[self.positions[entry]]
+        return char if isinstance(char, str) else chr(char)
+
+    def text(self, start, end):
+        text = self.json[start:end]
+        return text if isinstance(text, str) else str(text, "utf-8")
+
+    def value_entry(self, delim):
+        """Return the index entry of the value following the delimiter at
+        entry 'delim' (None for a number or literal, which has no entry), and
+        the entry of the comma or closing bracket after the value.
+        """
+        entry = delim + 1
+        char = self.char(entry)
+        if char in "{[":
+            return entry, self.closes[entry] + 1
+        elif char == '"':
+            return entry, entry + 1
+        return None, entry
+
+    def string(self, entry):
+        # Decode the string whose opening quotation mark is at 'entry'
+        return lex_string(self.text(self.positions[entry],
+                                    self.positions[entry + 1]), 0)[0]
+
+    def value(self, delim):
+        # Decode the value following the delimiter at entry 'delim', keeping
+        # objects and arrays lazy
+        entry, after = self.value_entry(delim)
+        if entry is None:
+            return parse_scalar(self.text(self.positions[delim] + 1,
+                                          self.positions[after]).strip())
+        char = self.char(entry)
+        if char == "{":
+            return LazyObject(self, entry)
+        elif char == "[":
+            return LazyArray(self, entry)
+        return self.string(entry)
+
+    def materialize(self, entry):
+        # Fully parse the object or array starting at 'entry'
+        start = self.positions[entry]
+        end = self.positions[self.closes[entry]] + 1
+        return parse(self.json[start:end])[1]
+
+class LazyObject:
+    """Read-only view of a JSON object in a LazyDocument. Keys are decoded
+    on first access, values only when they are looked up.
+    """
+
+    def __init__(self, doc, entry):
+        self.doc = doc
+        self.entry = entry
+        self._members = None
+
+    def members(self):
+        # Map each key to the index entry of the colon following it
+        if self._members is None:
+            doc = self.doc
+            end = doc.closes[self.entry]
+            members = {}
+            entry = self.entry + 1
+            while entry < end:
+                if doc.char(entry) != '"' or doc.char(entry + 1) != ":":
+                    raise ValueError("object key must be a string followed by colon")
+                members[doc.string(entry)] = entry + 1
+                entry = doc.value_entry(entry + 1)[1] + 1
+            self._members = members
+        return self._members
+
+    def __getitem__(self, key):
+        return self.doc.value(self.members()[key])
+
+    def __contains__(self, key):
+        return key in self.members()
+
+    def __iter__(self):
+        return iter(self.members())
+
+    def __len__(self):
+        return len(self.members())
+
+    def keys(self):
+        return self.members().keys()
+
+    def materialize(self):
+        return self.doc.materialize(self.entry)
+
+class LazyArray:
+    """Read-only view of a JSON array in a LazyDocument. Elements are
+    decoded only when they are indexed.
+    """
+
+    def __init__(self, doc, entry):
+        self.doc = doc
+        self.entry = entry
+        self._delims = None
+
+    def delims(self):
+        # Index entries of the [ or comma preceding each element
+        if self._delims is None:
+            doc = self.doc
+            end = doc.closes[self.entry]
+            delims = []
+            start = doc.positions[self.entry] + 1
+            if end > self.entry + 1 or doc.text(start, doc.positions[end]).strip():
+                delim = self.entry
+                while delim != end:
+                    delims.append(delim)
+                    delim = doc.value_entry(delim)[1]
+            self._delims = delims
+        return self._delims
+
+    def __getitem__(self, i):
+        return self.doc.value(self.delims()[i])
+
+    def __iter__(self):
+        return (self.doc.value(delim) for delim in self.delims())
+
+    def __len__(self):
+        return len(self.delims())
+
+    def materialize(self):
+        return self.doc.materialize(self.entry)
+
+def parse_lazy(json):
+    """Index json and return a LazyObject or LazyArray for its root, so that
+    e.g. parse_lazy(json)["stats"]["agents"] decodes nothing else.
+    """
+    doc = LazyDocument(json)
+    if doc.char(0) == "{":
+        return LazyObject(doc, 0)
+    elif doc.char(0) == "[":
+        return LazyArray(doc, 0)
+    raise ValueError("JSON must begin with a curly brace or bracket")
 
 if __name__ == "__main__":
-    with open(sys.argv[1]) as f:
+    # perf.py is shared with the scripts in the parent directory
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import perf
+
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument("json_file")
+    arg_parser.add_argument("--stream", action="store_true",
+                            help="read the file in chunks instead of all at once")
+    arg_parser.add_argument("--mmap", action="store_true",
+                            help="lex the memory-mapped UTF-8 file in place")
+    arg_parser.add_argument("--lines", action="store_true",
+                            help="parse a JSON Lines file, one document per line")
+    arg_parser.add_argument("--workers", type=int,
+                            help="worker processes for --lines (default: CPUs)")
+    arg_parser.add_argument("--python-lexer", action="store_true",
+                            help="use lex() even if parse_funcs.so is built")
+    arg_parser.add_argument("--cache", action="store_true",
+                            help="parse through a ParseCache")
+    arg_parser.add_argument("--cache-dir",
+                            help="directory the ParseCache pickles results to")
+    arg_parser.add_argument("--profile", action="store_true",
+                            help="run the 100 parses under cProfile")
+    arg_parser.add_argument("--stats", action="store_true",
+                            help="report parse() phase times, token counts, "
+                                 "escapes and peak memory")
+    perf.add_report_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    if args.report == "-" and (args.stream or args.mmap or args.lines):
+        # The parsed documents are printed to stdout
+        arg_parser.error("--report - cannot be used with --stream, --mmap or"
+                         " --lines")
+    report = perf.Report("json_parser", args.trace_memory, vars(args))
+    if args.python_lexer:
+        use_native_lexer = False
+    if args.stream or args.mmap or args.lines:
+        with report.measure("parse"):
+            if args.stream:
+                with open(args.json_file) as f:
+                    print(parse_stream(f))
+            elif args.mmap:
+                print(parse_file(args.json_file)[1])
+            else:
+                for obj in parse_lines(args.json_file, workers=args.workers):
+                    perf.count("documents")
+                    print(obj)
+        if args.report:
+            report.write(args.report)
+        sys.exit()
+
+    with open(args.json_file) as f:
         json = f.read()
     # multiple files end in Unicode 10 control code
     json = json[:-1]
-    #pr = cProfile.Profile()
-    #pr.enable()
-    start = time.time()
-    for _ in range(100):
-        obj = parse(json)
-    #pr.disable()
-    #pr.print_stats()
-    elapsed = time.time() - start
+    if args.stats:
+        stats = {}
+        obj = parse(json, stats=stats)
+        # Peak memory comes from a second run, as tracemalloc skews timings
+        memory_stats = {}
+        tracemalloc.start()
+        parse(json, stats=memory_stats)
+        tracemalloc.stop()
+        stats["peak_memory"] = memory_stats["peak_memory"]
+        for name, value in stats.items():
+            print(f"{name}: {value}")
+        sys.exit()
+
+    if args.profile:
+        pr = cProfile.Profile()
+        pr.enable()
+    parse_json = parse
+    if args.cache or args.cache_dir:
+        parse_json = ParseCache(directory=args.cache_dir).parse
+    with report.measure("parse x100"):
+        for _ in range(100):
+            obj = parse_json(json)
+    perf.count("parses", 100)
+    perf.count("bytes", 100 * len(json))
+    if args.profile:
+        pr.disable()
+        pstats.Stats(pr).sort_stats("cumulative").print_stats(20)
     print(obj)
-    print("elapsed:", elapsed)
+    print("elapsed:", report.phases["parse x100"]["seconds"])
+    if args.report:
+        report.write(args.report)
 
     # Time per 100 iterations of lexing and parsing (seconds)
     # 1.33 - lots of next() calls
     # 1.18 - combined lex() and next()
     # 1.27 - escaped characters implemented (full JSON spec supported)
     # 1.25 - call C function to lex numbers
+    # lex_tokens() lexes the whole buffer in C: 0.064 -> 0.014 (4.4x) for the
+    # document in test_full_parsing()
@@ -47,3 +47,502 @@ void print_string(size_t len, wchar_t *wchar) {
     }
     printf("\n");
 }
+
+static int is_digit(Py_UCS4 c) {
+    return '0' <= c && c <= '9';
+}
+
+static int hex_value(Py_UCS4 c) {
+    if ('0' <= c && c <= '9') {
+        return c - '0';
+    }
+    if ('a' <= c && c <= 'f') {
+        return c - 'a' + 10;
+    }
+    if ('A' <= c && c <= 'F') {
+        return c - 'A' + 10;
+    }
+    return -1;
+}
+
+// Return the index past the closing quotation mark of the string starting at
+// json[i], or -1 with ValueError set. *escaped is set if any backslash is found
+static Py_ssize_t scan_string(int kind, const void *data, Py_ssize_t len,
+                              Py_ssize_t i, int *escaped) {
+    *escaped = 0;
+    i++;
+    while (i < len) {
+        Py_UCS4 c = PyUnicode_READ(kind, data, i);
+        if (c == '"') {
+            return i + 1;
+        }
+        if (c != '\\') {
+            i++;
+            continue;
+        }
+        *escaped = 1;
+        if (i + 1 >= len) {
+            break;
+        }
+        c = PyUnicode_READ(kind, data, i + 1);
+        if (c == 'u') {
+            for (int j = 2; j < 6; j++) {
+                if (i + j >= len || hex_value(PyUnicode_READ(kind, data, i + j)) < 0) {
+                    PyErr_SetString(PyExc_ValueError, "invalid escaped Unicode");
+                    return -1;
+                }
+            }
+            i += 6;
+        } else if (c < 128 && c != '\0' && strchr("\"\\/bfnrt", (int)c) != NULL) {
+            i += 2;
+        } else {
+            PyErr_Format(PyExc_ValueError,
+                         "backslash followed by invalid character: %c", (int)c);
+            return -1;
+        }
+    }
+    PyErr_SetString(PyExc_ValueError, "unterminated string");
+    return -1;
+}
+
+// Append code point c to utf8 and return the number of bytes written
+static int encode_utf8(char *utf8, Py_UCS4 c) {
+    if (c < 0x80) {
+        utf8[0] = (char)c;
+        return 1;
+    }
+    if (c < 0x800) {
+        utf8[0] = (char)(0xc0 | (c >> 6));
+        utf8[1] = (char)(0x80 | (c & 0x3f));
+        return 2;
+    }
+    utf8[0] = (char)(0xe0 | (c >> 12));
+    utf8[1] = (char)(0x80 | ((c >> 6) & 0x3f));
+    utf8[2] = (char)(0x80 | (c & 0x3f));
+    return 3;
+}
+
+// Build the str for the UTF-8 bytes data[start:end], the contents of a string
+// token. Only this token is decoded, never the whole buffer.
+static PyObject *decode_utf8_string(const char *data, Py_ssize_t start,
+                                    Py_ssize_t end, int escaped) {
+    if (!escaped) {
+        return PyUnicode_DecodeUTF8(data + start, end - start, "strict");
+    }
+    // Escapes never decode to more bytes than they occupy
+    char *utf8 = PyMem_Malloc(end - start);
+    if (utf8 == NULL) {
+        return PyErr_NoMemory();
+    }
+    Py_ssize_t n = 0;
+    for (Py_ssize_t i = start; i < end; i++) {
+        char c = data[i];
+        if (c != '\\') {
+            utf8[n++] = c;
+            continue;
+        }
+        c = data[++i];
+        switch (c) {
+        case 'b': utf8[n++] = '\b'; break;
+        case 'f': utf8[n++] = '\f'; break;
+        case 'n': utf8[n++] = '\n'; break;
+        case 'r': utf8[n++] = '\r'; break;
+        case 't': utf8[n++] = '\t'; break;
+        case 'u': {
+            Py_UCS4 code_point = 0;
+            for (int j = 1; j < 5; j++) {
+                code_point = (code_point << 4) | hex_value((Py_UCS1)data[i + j]);
+            }
+            n += encode_utf8(utf8 + n, code_point);
+            i += 4;
+            break;
+        }
+        default: utf8[n++] = c;
+        }
+    }
+    // surrogatepass keeps lone \uD800-\uDFFF escapes, as lex() does
+    PyObject *token = PyUnicode_DecodeUTF8(utf8, n, "surrogatepass");
+    PyMem_Free(utf8);
+    return token;
+}
+
+// Build the str for json[start:end], the contents of a string token
+static PyObject *decode_string(PyObject *json, int kind, const void *data,
+                               Py_ssize_t start, Py_ssize_t end, int escaped) {
+    if (json == NULL) {
+        return decode_utf8_string(data, start, end, escaped);
+    }
+    if (!escaped) {
+        return PyUnicode_Substring(json, start, end);
+    }
+    Py_UCS4 *chars = PyMem_Malloc((end - start) * sizeof(Py_UCS4));
+    if (chars == NULL) {
+        return PyErr_NoMemory();
+    }
+    Py_ssize_t n = 0;
+    for (Py_ssize_t i = start; i < end; i++) {
+        Py_UCS4 c = PyUnicode_READ(kind, data, i);
+        if (c != '\\') {
+            chars[n++] = c;
+            continue;
+        }
+        c = PyUnicode_READ(kind, data, ++i);
+        switch (c) {
+        case 'b': chars[n++] = '\b'; break;
+        case 'f': chars[n++] = '\f'; break;
+        case 'n': chars[n++] = '\n'; break;
+        case 'r': chars[n++] = '\r'; break;
+        case 't': chars[n++] = '\t'; break;
+        case 'u':
+            c = 0;
+            for (int j = 1; j < 5; j++) {
+                c = (c << 4) | hex_value(PyUnicode_READ(kind, data, i + j));
+            }
+            chars[n++] = c;
+            i += 4;
+            break;
+        default: chars[n++] = c;
+        }
+    }
+    PyObject *token = PyUnicode_FromKindAndData(PyUnicode_4BYTE_KIND, chars, n);
+    PyMem_Free(chars);
+    return token;
+}
+
+// Return the index past the number starting at json[i], or -1 with ValueError
+static Py_ssize_t scan_number(int kind, const void *data, Py_ssize_t len,
+                              Py_ssize_t i) {
+#define AT(idx) ((idx) < len ? PyUnicode_READ(kind, data, idx) : 0)
+    if (AT(i) == '-') {
+        i++;
+    }
+    if (!is_digit(AT(i))) {
+        PyErr_SetString(PyExc_ValueError, "minus sign not followed by digits");
+        return -1;
+    }
+    if (AT(i) == '0' && is_digit(AT(i + 1))) {
+        PyErr_SetString(PyExc_ValueError,
+                        "JSON numbers cannot have leading zeroes");
+        return -1;
+    }
+    while (is_digit(AT(i))) {
+        i++;
+    }
+    if (AT(i) == '.') {
+        if (!is_digit(AT(i + 1))) {
+            PyErr_SetString(PyExc_ValueError,
+                            "decimal point not followed by digits");
+            return -1;
+        }
+        i++;
+        while (is_digit(AT(i))) {
+            i++;
+        }
+    }
+    if (AT(i) == 'e' || AT(i) == 'E') {
+        i++;
+        if (AT(i) == '+' || AT(i) == '-') {
+            i++;
+        }
+        if (!is_digit(AT(i))) {
+            PyErr_SetString(PyExc_ValueError, "exponent not followed by digits");
+            return -1;
+        }
+        while (is_digit(AT(i))) {
+            i++;
+        }
+    }
+    return i;
+#undef AT
+}
+
+// With ints set, a number without fraction or exponent becomes an exact int
+static PyObject *decode_number(int kind, const void *data, Py_ssize_t start,
+                               Py_ssize_t end, int ints) {
+    char small[64];
+    char *digits = small;
+    int integral = 1;
+    if (end - start >= (Py_ssize_t)sizeof(small)) {
+        digits = PyMem_Malloc(end - start + 1);
+        if (digits == NULL) {
+            return PyErr_NoMemory();
+        }
+    }
+    for (Py_ssize_t i = start; i < end; i++) {
+        digits[i - start] = (char)PyUnicode_READ(kind, data, i);
+        integral &= digits[i - start] == '-' || is_digit(digits[i - start]);
+    }
+    digits[end - start] = '\0';
+    if (ints && integral) {
+        PyObject *token = PyLong_FromString(digits, NULL, 10);
+        if (digits != small) {
+            PyMem_Free(digits);
+        }
+        return token;
+    }
+    double value = PyOS_string_to_double(digits, NULL, NULL);
+    if (digits != small) {
+        PyMem_Free(digits);
+    }
+    if (value == -1.0 && PyErr_Occurred()) {
+        return NULL;
+    }
+    return PyFloat_FromDouble(value);
+}
+
+static int literal_at(int kind, const void *data, Py_ssize_t len, Py_ssize_t i,
+                      const char *literal) {
+    for (; *literal; literal++, i++) {
+        if (i >= len || PyUnicode_READ(kind, data, i) != (Py_UCS4)*literal) {
+            return 0;
+        }
+    }
+    return 1;
+}
+
+// Token objects for the structural characters, in STRUCTURALS order, set by
+// json_parser.py so that they can be told apart from string tokens
+static const char STRUCTURALS[] = "{}[]:,";
+static PyObject *structural_tokens = NULL;
+
+int set_structural_tokens(PyObject *tokens) {
+    if (!PyTuple_Check(tokens) ||
+        PyTuple_GET_SIZE(tokens) != (Py_ssize_t)strlen(STRUCTURALS)) {
+        PyErr_SetString(PyExc_TypeError,
+                        "expected a tuple of tokens for {}[]:, in that order");
+        return -1;
+    }
+    Py_INCREF(tokens);
+    Py_XSETREF(structural_tokens, tokens);
+    return 0;
+}
+
+// json is NULL when data holds UTF-8 bytes rather than the str's characters
+static PyObject *lex_chars(PyObject *json, int kind, const void *data,
+                           Py_ssize_t len, int ints) {
+    PyObject *tokens = PyList_New(0);
+    if (tokens == NULL) {
+        return NULL;
+    }
+    Py_ssize_t i = 0;
+    while (i < len) {
+        Py_UCS4 c = PyUnicode_READ(kind, data, i);
+        PyObject *token;
+        if (c == '{' || c == '}' || c == '[' || c == ']' || c == ':' || c == ',') {
+            if (structural_tokens != NULL) {
+                token = PyTuple_GET_ITEM(structural_tokens,
+                                         strchr(STRUCTURALS, (int)c) - STRUCTURALS);
+                Py_INCREF(token);
+            } else {
+                token = PyUnicode_FromOrdinal(c);
+            }
+            i++;
+        } else if (c == '"') {
+            int escaped;
+            Py_ssize_t end = scan_string(kind, data, len, i, &escaped);
+            if (end < 0) {
+                goto error;
+            }
+            token = decode_string(json, kind, data, i + 1, end - 1, escaped);
+            i = end;
+        } else if (c == '-' || is_digit(c)) {
+            Py_ssize_t end = scan_number(kind, data, len, i);
+            if (end < 0) {
+                goto error;
+            }
+            token = decode_number(kind, data, i, end, ints);
+            i = end;
+        } else if (literal_at(kind, data, len, i, "true")) {
+            token = Py_True;
+            Py_INCREF(token);
+            i += 4;
+        } else if (literal_at(kind, data, len, i, "false")) {
+            token = Py_False;
+            Py_INCREF(token);
+            i += 5;
+        } else if (literal_at(kind, data, len, i, "null")) {
+            token = Py_None;
+            Py_INCREF(token);
+            i += 4;
+        } else if (Py_UNICODE_ISSPACE(c) && (json != NULL || c < 0x80)) {
+            i++;
+            continue;
+        } else {
+            PyErr_Format(PyExc_ValueError, "unexpected character=%c at index %zd",
+                         (int)c, i);
+            goto error;
+        }
+        if (token == NULL) {
+            goto error;
+        }
+        int failed = PyList_Append(tokens, token);
+        Py_DECREF(token);
+        if (failed) {
+            goto error;
+        }
+    }
+    return tokens;
+
+error:
+    Py_DECREF(tokens);
+    return NULL;
+}
+
+static int is_json_space(Py_UCS4 c) {
+    return c == ' ' || c == '\n' || c == '\r' || c == '\t';
+}
+
+// Check that the text, ignoring surrounding whitespace, is an object or array
+static int check_ends(int kind, const void *data, Py_ssize_t len) {
+    Py_ssize_t start = 0;
+    Py_ssize_t end = len - 1;
+    while (start < len && is_json_space(PyUnicode_READ(kind, data, start))) {
+        start++;
+    }
+    while (end > start && is_json_space(PyUnicode_READ(kind, data, end))) {
+        end--;
+    }
+    Py_UCS4 first = start < len ? PyUnicode_READ(kind, data, start) : 0;
+    Py_UCS4 last = start < len ? PyUnicode_READ(kind, data, end) : 0;
+    if (!((first == '{' && last == '}') || (first == '[' && last == ']'))) {
+        PyErr_SetString(PyExc_ValueError,
+                        "JSON must begin and end with curly braces or brackets");
+        return -1;
+    }
+    return 0;
+}
+
+// Lex a whole JSON document in one call. Returns the same token list as the
+// pure-Python lex() so parse_obj() and parse_array() can consume it:
+// structural characters are the objects given to set_structural_tokens().
+// json is either a str or an object exporting a buffer of UTF-8 bytes
+// (bytes, memoryview, mmap), which is lexed in place without a copy.
+// With ints set, integral numbers are returned as int rather than float.
+PyObject *lex_tokens(PyObject *json, int ints) {
+    if (PyUnicode_Check(json)) {
+        if (PyUnicode_READY(json) < 0) {
+            return NULL;
+        }
+        int kind = PyUnicode_KIND(json);
+        const void *data = PyUnicode_DATA(json);
+        Py_ssize_t len = PyUnicode_GET_LENGTH(json);
+        if (check_ends(kind, data, len) < 0) {
+            return NULL;
+        }
+        return lex_chars(json, kind, data, len, ints);
+    }
+
+    Py_buffer view;
+    if (PyObject_GetBuffer(json, &view, PyBUF_SIMPLE) < 0) {
+        return NULL;
+    }
+    PyObject *tokens = NULL;
+    if (check_ends(PyUnicode_1BYTE_KIND, view.buf, view.len) == 0) {
+        // Every byte of a multibyte UTF-8 sequence is >= 0x80, so structural
+        // characters can be found by reading the buffer one byte at a time
+        tokens = lex_chars(NULL, PyUnicode_1BYTE_KIND, view.buf, view.len, ints);
+    }
+    PyBuffer_Release(&view);
+    return tokens;
+}
+
+typedef struct {
+    int64_t *items;
+    Py_ssize_t len;
+    Py_ssize_t cap;
+} Int64Array;
+
+static int int64_push(Int64Array *array, int64_t value) {
+    if (array->len == array->cap) {
+        Py_ssize_t cap = array->cap ? array->cap * 2 : 1024;
+        int64_t *items = PyMem_Realloc(array->items, cap * sizeof(int64_t));
+        if (items == NULL) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        array->items = items;
+        array->cap = cap;
+    }
+    array->items[array->len++] = value;
+    return 0;
+}
+
+// Record the offset of every structural character ({}[]:, and the opening
+// quotation mark of each string) in one pass. Returns a tuple of two bytes
+// objects holding int64 arrays: the offsets, and for each { or [ the index of
+// its matching } or ] in the offsets array (0 for every other entry).
+static PyObject *index_chars(int kind, const void *data, Py_ssize_t len) {
+    Int64Array positions = {0}, closes = {0}, stack = {0};
+    PyObject *result = NULL;
+    Py_ssize_t i = 0;
+    while (i < len) {
+        Py_UCS4 c = PyUnicode_READ(kind, data, i);
+        if (c == '"') {
+            int escaped;
+            Py_ssize_t end = scan_string(kind, data, len, i, &escaped);
+            if (end < 0 || int64_push(&positions, i) < 0
+                    || int64_push(&closes, 0) < 0) {
+                goto done;
+            }
+            i = end;
+            continue;
+        }
+        if (c == '{' || c == '[') {
+            if (int64_push(&stack, positions.len) < 0) {
+                goto done;
+            }
+        } else if (c == '}' || c == ']') {
+            Py_UCS4 open = stack.len ? PyUnicode_READ(
+                kind, data, positions.items[stack.items[stack.len - 1]]) : 0;
+            if ((c == '}' && open != '{') || (c == ']' && open != '[')) {
+                PyErr_Format(PyExc_ValueError, "unmatched %c at index %zd",
+                             (int)c, i);
+                goto done;
+            }
+            closes.items[stack.items[--stack.len]] = positions.len;
+        } else if (c != ':' && c != ',') {
+            i++;
+            continue;
+        }
+        if (int64_push(&positions, i) < 0 || int64_push(&closes, 0) < 0) {
+            goto done;
+        }
+        i++;
+    }
+    if (stack.len) {
+        PyErr_SetString(PyExc_ValueError, "unclosed object or array");
+        goto done;
+    }
+    if (positions.len == 0) {
+        PyErr_SetString(PyExc_ValueError, "JSON has no object or array");
+        goto done;
+    }
+    result = Py_BuildValue("(y#y#)",
+                           (const char *)positions.items,
+                           positions.len * (Py_ssize_t)sizeof(int64_t),
+                           (const char *)closes.items,
+                           closes.len * (Py_ssize_t)sizeof(int64_t));
+
+done:
+    PyMem_Free(positions.items);
+    PyMem_Free(closes.items);
+    PyMem_Free(stack.items);
+    return result;
+}
+
+PyObject *structural_index(PyObject *json) {
+    if (PyUnicode_Check(json)) {
+        if (PyUnicode_READY(json) < 0) {
+            return NULL;
+        }
+        return index_chars(PyUnicode_KIND(json), PyUnicode_DATA(json),
+                           PyUnicode_GET_LENGTH(json));
+    }
+    Py_buffer view;
+    if (PyObject_GetBuffer(json, &view, PyBUF_SIMPLE) < 0) {
+        return NULL;
+    }
+    PyObject *result = index_chars(PyUnicode_1BYTE_KIND, view.buf, view.len);
+    PyBuffer_Release(&view);
+    return result;
+}
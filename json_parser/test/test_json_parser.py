@@ -1,6 +1,12 @@
+import array
 import ctypes
+import io
+import json
+import tracemalloc
+
 import pytest
 
+import bench
 import json_parser
 
 def test_lex_simple():
@@ -24,6 +30,22 @@ def test_leading_zero_error():
         json_parser.lex(json, ctypes.c_wchar_p(json))
     assert "JSON numbers cannot have leading zeroes" in str(excinfo.value)
 
+def test_lex_numbers():
+    # The Python lexer follows the same number grammar as lex_tokens()
+    json = """[1e5, -0.5e1, 1.5E+3, 0, -0, 12]"""
+    assert json_parser.lex(json, None)[1::2] == [1e5, -5.0, 1.5e3, 0.0, -0.0,
+                                                 12.0]
+    for json, message in (("[1.]", "decimal point not followed by digits"),
+                          ("[01]", "JSON numbers cannot have leading zeroes"),
+                          ("[-01]", "JSON numbers cannot have leading zeroes"),
+                          ("[1e+]", "exponent not followed by digits"),
+                          ("[-]", "minus sign not followed by digits")):
+        with pytest.raises(ValueError, match=message):
+            json_parser.lex(json, None)
+        if json_parser.parse_funcs is not None:
+            with pytest.raises(ValueError, match=message):
+                json_parser.parse_funcs.lex_tokens(json, 0)
+
 def test_parse_array_without_objects():
     json = "[1, 2, 3]"
     _, obj = json_parser.parse(json)
@@ -108,7 +130,392 @@ def test_lex_escaped_characters():
     print("expected: ", expected)
     assert tokens == expected
 
+def test_parse_nested_arrays():
+    _, obj = json_parser.parse("""[[1, [2]], [], {"a": [[]]}]""")
+    assert obj == [[1.0, [2.0]], [], {"a": [[]]}]
+
+def test_parse_nested_objects():
+    _, obj = json_parser.parse("""{"x": {"a": {"b": 1}}, "y": 2}""")
+    assert obj == {"x": {"a": {"b": 1.0}}, "y": 2.0}
+    _, obj = json_parser.parse("""{"a": {}, "b": [{"c": {}}], "d": 1}""")
+    assert obj == {"a": {}, "b": [{"c": {}}], "d": 1.0}
+
 def test_parse_high_code_points():
     json = """{"இ": "Σ"}"""
     _, obj = json_parser.parse(json)
     assert obj == {"இ": "Σ"}
+
+def test_lex_stream_tokens_span_chunks():
+    # Every chunk boundary falls inside a token for some chunk size
+    json = r"""{"key": [true, false, null, -12.5e+3, "esc\"aped઴"], "n": 7}"""
+    expected = json_parser.lex(json, ctypes.c_wchar_p(json))
+    for chunk_size in range(1, 12):
+        tokens = list(json_parser.lex_stream(io.StringIO(json), chunk_size))
+        assert tokens == expected
+
+def test_parse_stream():
+    json = """{"stats":{"agents":1000,"ships":[1, 2, {"a": []}]},"x":"y"}"""
+    _, expected = json_parser.parse(json)
+    for chunk_size in (1, 3, 16, json_parser.CHUNK_SIZE):
+        assert json_parser.parse_stream(io.StringIO(json), chunk_size) == expected
+    # Strings holding a structural character are values, not structure
+    for json, expected in (('{"a": "{"}', {"a": "{"}), ('["]"]', ["]"]),
+                           ('{"a": ","}', {"a": ","}),
+                           ('{":": [":", "[", "}"]}', {":": [":", "[", "}"]})):
+        for chunk_size in (1, json_parser.CHUNK_SIZE):
+            assert json_parser.parse_stream(io.StringIO(json), chunk_size) == expected
+
+def test_parse_stream_numbers():
+    # Exponents without a fraction or sign, and numbers split across chunks
+    json = """[1e5, 1.5e3, 2E+3, -0.5e1, 0, -0, 123456789]"""
+    expected = [1e5, 1.5e3, 2e3, -5.0, 0.0, -0.0, 123456789.0]
+    for chunk_size in range(1, 12):
+        assert json_parser.parse_stream(io.StringIO(json), chunk_size) == expected
+    for json, message in (("[1.]", "decimal point not followed by digits"),
+                          ("[1.e5]", "decimal point not followed by digits"),
+                          ("[01]", "JSON numbers cannot have leading zeroes"),
+                          ("[1e]", "exponent not followed by digits"),
+                          ("[-]", "minus sign not followed by digits")):
+        for chunk_size in (2, json_parser.CHUNK_SIZE):
+            with pytest.raises(ValueError, match=message):
+                json_parser.parse_stream(io.StringIO(json), chunk_size)
+
+def test_parse_stream_truncated():
+    with pytest.raises(ValueError):
+        json_parser.parse_stream(io.StringIO("""{"key": "val"""), 4)
+    with pytest.raises(ValueError):
+        json_parser.parse_stream(io.StringIO("""{"key": [1, 2"""), 4)
+
+native = pytest.mark.skipif(json_parser.parse_funcs is None,
+                            reason="parse_funcs.so not built")
+
+@native
+def test_lex_tokens_matches_lex():
+    for json in ("""{"list":[true, false, null, 21, 33.0, 10.01e-1, -5, 0.1]}""",
+                 r"""["word", "\\", "\\\\", "\"escaped", "\t", "઴", "\/"]""",
+                 """{"இ": "Σ", "nested": {"a": [[], {}]}}"""):
+        expected = json_parser.lex(json, ctypes.c_wchar_p(json))
+        assert json_parser.parse_funcs.lex_tokens(json, False) == expected
+
+def test_parse_structural_strings():
+    # String tokens equal to a structural character are values
+    cases = (('{"a": "{"}', {"a": "{"}), ('["]"]', ["]"]),
+             ('{"a": ",", "b": [":", "}", "["]}', {"a": ",", "b": [":", "}", "["]}),
+             ('{"[": {"]": ","}}', {"[": {"]": ","}}))
+    for use_native_lexer in (True, False):
+        json_parser.use_native_lexer = use_native_lexer
+        try:
+            for json, expected in cases:
+                assert json_parser.parse(json)[1] == expected
+        finally:
+            json_parser.use_native_lexer = True
+    json = '["{", 1]'
+    tokens = json_parser.lex(json, ctypes.c_wchar_p(json))
+    assert tokens[0] is json_parser.LBRACKET and type(tokens[1]) is str
+
+@native
+def test_lex_tokens_structurals():
+    tokens = json_parser.parse_funcs.lex_tokens('{"{": [":"]}', False)
+    assert tokens == ["{", "{", ":", "[", ":", "]", "}"]
+    assert [type(token) is json_parser.Structural for token in tokens] == [
+        True, False, True, True, False, True, True]
+    assert tokens[0] is json_parser.LBRACE
+
+@native
+def test_lex_tokens_errors():
+    for json in ("""{"key":05}""", """{"key":"unterminated}""", """[1.]""",
+                 r"""["\x"]""", r"""["\u12g4"]""", """[nul]""", """{"a":1"""):
+        with pytest.raises(ValueError):
+            json_parser.parse_funcs.lex_tokens(json, False)
+
+def test_parse_without_native_lexer(monkeypatch):
+    monkeypatch.setattr(json_parser, "parse_funcs", None)
+    _, obj = json_parser.parse("""{"a": [1.5, -2, "\\n"], "b": null}""")
+    assert obj == {"a": [1.5, -2.0, "\n"], "b": None}
+
+def test_parse_utf8_buffers(tmp_path):
+    json = """{"இ": "Σ", "esc": "\\u00e9\\n\\"", "list": [1, true, null]}\n"""
+    _, expected = json_parser.parse(json.strip())
+    data = json.encode("utf-8")
+    assert json_parser.parse(data)[1] == expected
+    assert json_parser.parse(memoryview(data))[1] == expected
+    path = tmp_path / "doc.json"
+    path.write_bytes(data)
+    assert json_parser.parse_file(path)[1] == expected
+
+@native
+def test_lex_tokens_invalid_utf8():
+    with pytest.raises(UnicodeDecodeError):
+        json_parser.parse_funcs.lex_tokens(b'["\xff"]', False)
+
+def test_parse_utf8_without_native_lexer(monkeypatch):
+    monkeypatch.setattr(json_parser, "parse_funcs", None)
+    _, obj = json_parser.parse("""{"இ": ["Σ"]}\n""".encode("utf-8"))
+    assert obj == {"இ": ["Σ"]}
+
+LAZY_JSON = """{"status": "Space\\"Traders", "stats": {"agents": 1000, "ships": 2637},
+ "empty": [], "nothing": {}, "list": [true, "s", [1, 2], {"k": null}, -0.5e1 ]}"""
+
+def test_structural_index():
+    json = """{"a": [1, "b]"], "c": {}}"""
+    positions, closes = json_parser.structural_index(json)
+    assert [json[p] for p in positions] == ["{", '"', ":", "[", ",", '"', "]",
+                                            ",", '"', ":", "{", "}", "}"]
+    assert positions[closes[0]] == len(json) - 1
+    assert json[positions[closes[3]]] == "]"
+
+def test_structural_index_without_native(monkeypatch):
+    expected = [list(a) for a in json_parser.structural_index(LAZY_JSON)]
+    monkeypatch.setattr(json_parser, "parse_funcs", None)
+    for json in (LAZY_JSON, LAZY_JSON.encode("utf-8")):
+        assert [list(a) for a in json_parser.structural_index(json)] == expected
+    with pytest.raises(ValueError):
+        json_parser.structural_index("""{"a": [1}""")
+
+def test_parse_lazy():
+    _, expected = json_parser.parse(LAZY_JSON)
+    for json in (LAZY_JSON, LAZY_JSON.encode("utf-8")):
+        doc = json_parser.parse_lazy(json)
+        assert doc["status"] == 'Space"Traders'
+        assert doc["stats"]["agents"] == 1000
+        assert len(doc["empty"]) == 0 and len(doc["nothing"]) == 0
+        assert list(doc["list"])[:2] == [True, "s"]
+        assert doc["list"][2].materialize() == [1, 2]
+        assert doc["list"][3]["k"] is None
+        assert doc["list"][-1] == -5.0
+        assert list(doc.keys()) == list(expected)
+        assert doc.materialize() == expected
+        with pytest.raises(KeyError):
+            doc["missing"]
+
+def test_parse_file_lazy(tmp_path):
+    path = tmp_path / "doc.json"
+    path.write_text(LAZY_JSON)
+    assert json_parser.parse_file(path, lazy=True)["stats"]["ships"] == 2637
+
+def test_parse_lines(tmp_path):
+    records = [{"id": float(i), "tags": ["a", "b"] * (i % 3)} for i in range(200)]
+    lines = [f'{{"id": {i}, "tags": {["a", "b"] * (i % 3)}}}'.replace("'", '"')
+             for i in range(200)]
+    path = tmp_path / "records.jsonl"
+    path.write_text("\n".join(lines[:100]) + "\n\n" + "\n".join(lines[100:]))
+    for batch_size in (1, 64, 100000):
+        assert list(json_parser.parse_lines(path, batch_size, workers=2)) == records
+    assert list(json_parser.parse_lines(path, 64, workers=1)) == records
+
+def test_parse_many():
+    lines = ['{"n": %d}' % i for i in range(50)]
+    assert list(json_parser.parse_many(lines, batch_size=7, workers=2)) == [
+        {"n": float(i)} for i in range(50)]
+    assert list(json_parser.parse_many([], workers=2)) == []
+
+def test_parse_fused():
+    for json in (LAZY_JSON, """[[1, [2]], [], {"a": [[]]}]""",
+                 r"""["word", "\\", "\\\\", "\"escaped", "\t", "઴"]"""):
+        assert json_parser.parse_fused(json) == json_parser.parse(json)[1]
+    assert json_parser.parse_fused(LAZY_JSON.encode("utf-8"))["stats"]["ships"] == 2637
+
+def test_parse_fused_deep_nesting():
+    depth = 100000
+    obj = json_parser.parse_fused("[" * depth + "]" * depth)
+    for _ in range(depth - 1):
+        obj, = obj
+    assert obj == []
+    obj = json_parser.parse_fused('{"a":' * depth + "{}" + "}" * depth)
+    assert obj["a"]["a"]["a"] is not None
+
+def test_parse_fused_errors():
+    for json in ("""{"a" 1}""", """{"a": 1,}""", """[1, 2""", """[1 2]""",
+                 """{"a": "unterminated}""", """[05]""", """[1]]""", """"a\"""",
+                 """{1: 2}""", """[1, ]""", """{"a": [}""", ""):
+        with pytest.raises(ValueError):
+            json_parser.parse_fused(json)
+
+def test_iter_events():
+    json = """{"a": [1, {"b": null}], "c": "{", "d": {}, "e": [true, []]}"""
+    assert list(json_parser.iter_events(json)) == [
+        ("", "start_map", None),
+        ("", "map_key", "a"),
+        ("a", "start_array", None),
+        ("a.item", "number", 1.0),
+        ("a.item", "start_map", None),
+        ("a.item", "map_key", "b"),
+        ("a.item.b", "null", None),
+        ("a.item", "end_map", None),
+        ("a", "end_array", None),
+        ("", "map_key", "c"),
+        ("c", "string", "{"),
+        ("", "map_key", "d"),
+        ("d", "start_map", None),
+        ("d", "end_map", None),
+        ("", "map_key", "e"),
+        ("e", "start_array", None),
+        ("e.item", "boolean", True),
+        ("e.item", "start_array", None),
+        ("e.item", "end_array", None),
+        ("e", "end_array", None),
+        ("", "end_map", None),
+    ]
+
+def test_iter_events_errors():
+    for json in ("""{"a" 1 2}""", """[1 2]""", """{"a":1,}""", """[1,]""",
+                 """{"a":1 "b":2}""", """{1: 2}""", """{"a"}""", """[:]""",
+                 """[1]]""", """{"a": 1}{}""", """[}""", """{"a": [}""",
+                 """[1""", """ """, """1"""):
+        with pytest.raises(ValueError):
+            list(json_parser.iter_events(json))
+    assert list(json_parser.iter_events("[]")) == [
+        ("", "start_array", None), ("", "end_array", None)]
+
+def test_items():
+    json = """{"items": [{"price": 1.5, "tags": ["x"]}, {"price": 2},
+              {"name": "no price"}, {"price": 3, "sub": {"price": 100}}]}"""
+    f = io.StringIO(json)
+    assert sum(json_parser.items(f, "items.item.price", chunk_size=5)) == 6.5
+    assert list(json_parser.items(json, "items.item.tags")) == [["x"]]
+    assert list(json_parser.items(json, "items.item"))[3] == {
+        "price": 3.0, "sub": {"price": 100.0}}
+    assert list(json_parser.items(json, "missing")) == []
+
+def test_iter_events_numbers():
+    assert list(json_parser.items("[1e5, 1.5e3, 2E+3]", "item")) == [
+        1e5, 1.5e3, 2e3]
+    events = json_parser.iter_events(io.StringIO("""{"n": 1e5}"""), 3)
+    assert ("n", "number", 1e5) in list(events)
+    for json in ("[1.]", "[01]", "[1e]", """{"n": -}"""):
+        with pytest.raises(ValueError):
+            list(json_parser.items(json, "item"))
+        with pytest.raises(ValueError):
+            list(json_parser.iter_events(json))
+
+def test_parse_ints():
+    json = """{"big": 9007199254740993, "neg": -7, "one": 1, "float": 2.5}"""
+    expected = {"big": 9007199254740993, "neg": -7, "one": 1, "float": 2.5}
+    _, obj = json_parser.parse(json, ints=True)
+    assert obj == expected
+    assert type(obj["big"]) is int and type(obj["float"]) is float
+
+def test_parse_ints_without_native_lexer(monkeypatch):
+    monkeypatch.setattr(json_parser, "parse_funcs", None)
+    _, obj = json_parser.parse("""[9007199254740993, -7, 1, 2.5]""", ints=True)
+    assert obj == [9007199254740993, -7, 1, 2.5]
+    assert [type(value) for value in obj] == [int, int, int, float]
+
+def test_parse_intern_keys():
+    json = """[{"name": "a", "value": 1}, {"name": "b", "value": 2}]"""
+    _, objs = json_parser.parse(json, intern_keys=True)
+    first, second = (list(obj) for obj in objs)
+    assert first == second == ["name", "value"]
+    assert all(a is b for a, b in zip(first, second))
+
+def test_parse_numeric_arrays():
+    json = """{"ints": [1, 2, 3], "floats": [1, 2.5], "mixed": [1, "a"],
+              "empty": [], "bools": [true, false], "nested": [[1, 2], [3]]}"""
+    _, obj = json_parser.parse(json, ints=True, numeric_arrays="array")
+    assert obj["ints"] == array.array("q", [1, 2, 3])
+    assert obj["floats"] == array.array("d", [1.0, 2.5])
+    assert obj["mixed"] == [1, "a"]
+    assert obj["empty"] == [] and obj["bools"] == [True, False]
+    assert obj["nested"] == [array.array("q", [1, 2]), array.array("q", [3])]
+
+def test_parse_numeric_arrays_keep_big_ints():
+    # Ints that do not fit int64, or a double next to floats, stay exact
+    json = """{"big": [9223372036854775808, 1], "small": [-9223372036854775808, 1],
+              "mixed": [9007199254740993, 0.5], "exact": [9007199254740992, 0.5]}"""
+    for kind in ("array", "numpy"):
+        if kind == "numpy":
+            pytest.importorskip("numpy")
+        _, obj = json_parser.parse(json, ints=True, numeric_arrays=kind)
+        assert obj["big"] == [2 ** 63, 1] and type(obj["big"][0]) is int
+        assert obj["mixed"] == [2 ** 53 + 1, 0.5]
+        assert list(obj["small"]) == [-2 ** 63, 1]
+        assert list(obj["exact"]) == [2.0 ** 53, 0.5]
+        assert type(obj["small"]) is not list and type(obj["exact"]) is not list
+
+def test_lex_escaped_backslash_before_u():
+    json = r"""["a\\u00e9", "\\\"", "é\\"]"""
+    expected = ["[", "a\\u00e9", ",", '\\"', ",", "é\\", "]"]
+    assert json_parser.lex(json, ctypes.c_wchar_p(json)) == expected
+    assert json_parser.parse_fused(json) == expected[1::2]
+
+def test_lex_string_errors():
+    assert json_parser.lex_string(r'"aé\n" ,', 0) == ("aé\n", 6)
+    for json in ('"abc', '"a\\"', '"\\u00'):
+        with pytest.raises(IndexError):
+            json_parser.lex_string(json, 0)
+    for json in ('"\\x"', '"\\u00g0"'):
+        with pytest.raises(ValueError):
+            json_parser.lex_string(json, 0)
+
+def test_bench_corpora_match_stdlib():
+    for shape in bench.CORPORA:
+        corpus = bench.make_corpus(shape, 20000)
+        expected = json.loads(corpus)
+        assert json_parser.parse(corpus)[1] == expected
+        assert json_parser.parse_fused(corpus) == expected
+
+def test_parse_stats(monkeypatch):
+    json = r"""{"a": [1, 2.5, "\u00e9\n"], "b": {"c": null}}"""
+    stats = {}
+    _, obj = json_parser.parse(json, stats=stats)
+    assert obj == {"a": [1.0, 2.5, "é\n"], "b": {"c": None}}
+    assert stats["tokens"] == {"{": 2, "}": 2, "[": 1, "]": 1, ":": 3, ",": 3,
+                               "str": 4, "float": 2, "NoneType": 1}
+    assert stats["escapes"] == 2 and stats["unicode_escapes"] == 1
+    assert stats["lex_seconds"] >= 0 and stats["build_seconds"] >= 0
+    assert "peak_memory" not in stats
+
+    monkeypatch.setattr(json_parser, "use_native_lexer", False)
+    stats = {}
+    tracemalloc.start()
+    try:
+        json_parser.parse(json, stats=stats)
+    finally:
+        tracemalloc.stop()
+    assert stats["lexer"] == "python" and stats["peak_memory"] > 0
+    assert stats["lex_num_calls"] == 2
+
+def test_parse_cache():
+    cache = json_parser.ParseCache()
+    _, obj = cache.parse("""{"a": [1, {"b": 2}]}""")
+    assert obj == {"a": (1.0, {"b": 2.0})}
+    assert cache.parse(b"""{"a": [1, {"b": 2}]}""")[1] is obj
+    assert (cache.hits, cache.misses) == (1, 1)
+    with pytest.raises(TypeError):
+        obj["a"] = 1
+    _, ints = cache.parse("""{"a": [1, {"b": 2}]}""", ints=True)
+    assert ints is not obj and type(ints["a"][0]) is int
+
+def test_parse_cache_frozen_numeric_arrays():
+    cache = json_parser.ParseCache()
+    _, obj = cache.parse("""{"a": [1, 2]}""", ints=True, numeric_arrays="array")
+    assert obj["a"] == (1, 2)
+    with pytest.raises(TypeError):
+        obj["a"][0] = 99
+    pytest.importorskip("numpy")
+    _, obj = cache.parse("""{"a": [1, 2]}""", numeric_arrays="numpy")
+    with pytest.raises(ValueError):
+        obj["a"][0] = 99
+    assert cache.parse("""{"a": [1, 2]}""", numeric_arrays="numpy")[1]["a"].tolist() == [1, 2]
+
+def test_parse_cache_lru_eviction():
+    cache = json_parser.ParseCache(max_bytes=20, frozen=False)
+    for json in ("[1, 2, 3]", "[4, 5, 6]", "[1, 2, 3]", "[7, 8, 9]"):
+        cache.parse(json)
+    assert cache.misses == 3 and cache.size == 18
+    cache.parse("[4, 5, 6]")
+    assert cache.misses == 4
+
+def test_parse_cache_files(tmp_path):
+    path = tmp_path / "doc.json"
+    path.write_text("""{"a": 1}""")
+    cache = json_parser.ParseCache(directory=tmp_path / "cache")
+    assert cache.parse_file(path)[1] == {"a": 1.0}
+    assert cache.parse_file(path)[1] == {"a": 1.0}
+    path.write_text("""{"a": 22}""")
+    assert cache.parse_file(path)[1] == {"a": 22.0}
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    other = json_parser.ParseCache(directory=tmp_path / "cache")
+    assert other.parse("""{"a": 1}""")[1] == {"a": 1.0}
+    assert (other.disk_hits, other.misses) == (1, 0)
@@ -3,55 +3,386 @@
 '''
 Generates an incomplete representation of the Mandelbrot set.
 https://en.wikipedia.org/wiki/Mandelbrot_set
+
+matplotlib is only imported to draw or save PNGs, so .npy output and
+zoom sequences also run on machines without a display.
 '''
 
-import functools
+import argparse
+import concurrent.futures
+import os
 import time
-import matplotlib.pyplot as plt
+from multiprocessing import shared_memory
 import numpy as np
 
+import perf
+from perf import time_this
 
-def time_this(func):
-    '''Execution time decorator.'''
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        start = time.time()
-        result = func(*args, **kwargs)
-        end = time.time()
-        print(f'Execution time {func.__name__}(): {end - start}')
-        return result
-    return wrapper
+# The viewport that roughly covers the whole set
+X_BOUNDS = (-2.00, 0.47)
+Y_BOUNDS = (-1.12, 1.12)
+# Orbits closer than this to an earlier point are treated as periodic
+PERIOD_EPSILON = 1e-13
+# Viewports for benchmark_early_out(): (name, x_bounds, y_bounds)
+BENCHMARK_VIEWPORTS = (
+    ('whole set', X_BOUNDS, Y_BOUNDS),
+    ('seahorse valley', (-0.80, -0.70), (0.05, 0.15)),
+    ('elephant valley', (0.25, 0.35), (-0.05, 0.05)),
+    ('period-3 bulb', (-0.20, -0.05), (0.60, 0.75)),
+)
 
 
 @time_this
-def make_mandelbrot():
+def make_mandelbrot(pixel_amount_sqrt=220, max_iteration=800,
+                    x_bounds=X_BOUNDS, y_bounds=Y_BOUNDS, early_out=False):
     '''Approximate the mandelbrot set without using complex numbers.
     The effort of incorporating complex numbers is currently unknown, as is
     their effect on calculation time.
+
+    early_out=True skips points in the main cardioid and period-2 bulb, and
+    stops iterating once an orbit is found to be periodic.
     '''
     # Increase pixel_amount_sqrt and max_iteration to increase image clarity.
-    # The linspace() boundaries roughly set the correct problem space.
-    pixel_amount_sqrt = 220
-    x_coords = np.linspace(-2.00, 0.47, pixel_amount_sqrt)
-    y_coords = np.linspace(-1.12, 1.12, pixel_amount_sqrt)
+    # The default bounds roughly set the correct problem space.
+    x_coords = np.linspace(*x_bounds, pixel_amount_sqrt)
+    y_coords = np.linspace(*y_bounds, pixel_amount_sqrt)
     valid_x = []
     valid_y = []
     for x_coord in x_coords:
         for y_coord in y_coords:
+            if early_out and in_main_bulbs(x_coord, y_coord):
+                valid_x.append(x_coord)
+                valid_y.append(y_coord)
+                continue
             x = 0.0
             y = 0.0
+            x_saved = 0.0
+            y_saved = 0.0
+            next_save = 1
             iteration = 0
-            max_iteration = 800
             while (x * x + y * y) <= 4 and iteration < max_iteration:
                 x_temp = (x * x) - (y * y) + x_coord
                 y = (2 * x * y) + y_coord
                 x = x_temp
                 iteration += 1
+                if early_out:
+                    if abs(x - x_saved) <= PERIOD_EPSILON \
+                            and abs(y - y_saved) <= PERIOD_EPSILON:
+                        break
+                    if iteration == next_save:
+                        x_saved = x
+                        y_saved = y
+                        next_save *= 2
             if (x * x + y * y) <= 4:
                 valid_x.append(x_coord)
                 valid_y.append(y_coord)
 
-        plt.scatter(valid_x, valid_y, marker=',', s=1)
+    import matplotlib.pyplot as plt
+    # One scatter() call, rather than one per column over ever-growing lists
+    plt.scatter(valid_x, valid_y, marker=',', s=1)
+
+
+def in_main_bulbs(x, y):
+    '''True where the point lies in the main cardioid or the period-2 bulb,
+    which are inside the set and would use up every iteration.'''
+    q = (x - 0.25) ** 2 + y * y
+    return (q * (q + x - 0.25) <= 0.25 * y * y) | ((x + 1) ** 2 + y * y <= 0.0625)
+
+
+def escape_counts(x_coords, y_coords, max_iteration, smooth=False,
+                  early_out=False, stats=None, out=None):
+    '''Vectorized escape-time iteration over flat arrays of point
+    coordinates. Return a float array of iteration counts, max_iteration
+    for points that never escaped. Only the points still iterating (the
+    active set) are updated, so escaped points cost nothing afterwards.
+
+    With smooth=True, escaped points get a fractional count,
+    n + 1 - log2(log|z|), which removes the banding of integer counts.
+
+    With early_out=True, points in the main cardioid or period-2 bulb are
+    never iterated, and points whose orbit returns to a value saved at
+    iterations 1, 2, 4, 8, ... are taken to be in a cycle and stop early.
+    If a stats dict is given, stats['point_iterations'] is increased by
+    the number of point updates done. The counts are written to 'out'
+    instead of a new array if it is given.
+    '''
+    if out is None:
+        counts = np.full(x_coords.shape, float(max_iteration))
+    else:
+        counts = out
+        counts.fill(max_iteration)
+    active = np.arange(x_coords.size)
+    if early_out:
+        active = active[~in_main_bulbs(x_coords, y_coords)]
+    x_active = x_coords[active]
+    y_active = y_coords[active]
+    x = np.zeros_like(x_active)
+    y = np.zeros_like(y_active)
+    x_saved = np.zeros_like(x_active)
+    y_saved = np.zeros_like(y_active)
+    next_save = 1
+    point_iterations = 0
+    for iteration in range(1, max_iteration + 1):
+        if not active.size:
+            break
+        point_iterations += active.size
+        x_squared = x * x
+        y_squared = y * y
+        y = 2 * x * y + y_active
+        x = x_squared - y_squared + x_active
+        escaped = (x * x + y * y) > 4
+        remaining = ~escaped
+        if escaped.any():
+            if smooth:
+                log_abs_z = 0.5 * np.log(x[escaped] ** 2 + y[escaped] ** 2)
+                counts[active[escaped]] = iteration + 1 - np.log2(log_abs_z)
+            else:
+                counts[active[escaped]] = iteration
+        if early_out:
+            # Periodic orbits never escape, their count stays max_iteration
+            remaining &= (np.abs(x - x_saved) > PERIOD_EPSILON) \
+                | (np.abs(y - y_saved) > PERIOD_EPSILON)
+            if iteration == next_save:
+                x_saved, y_saved = x.copy(), y.copy()
+                next_save *= 2
+        if not remaining.all():
+            # Drop escaped and periodic points from the active set
+            active = active[remaining]
+            x, y = x[remaining], y[remaining]
+            x_active, y_active = x_active[remaining], y_active[remaining]
+            if early_out:
+                x_saved, y_saved = x_saved[remaining], y_saved[remaining]
+    if stats is not None:
+        stats['point_iterations'] = stats.get('point_iterations', 0) \
+            + point_iterations
+    return counts
+
+
+def mandelbrot_counts(width=220, height=220, x_bounds=X_BOUNDS,
+                      y_bounds=Y_BOUNDS, max_iteration=800, smooth=False,
+                      early_out=False, stats=None):
+    '''Return a (height, width) array of escape-time iteration counts for
+    the given viewport of the complex plane. Row 0 is the bottom edge.
+    '''
+    x_grid, y_grid = np.meshgrid(np.linspace(*x_bounds, width),
+                                 np.linspace(*y_bounds, height))
+    counts = escape_counts(x_grid.ravel(), y_grid.ravel(), max_iteration,
+                           smooth, early_out, stats)
+    return counts.reshape(height, width)
+
+
+def plot_counts(counts, x_bounds=X_BOUNDS, y_bounds=Y_BOUNDS,
+                max_iteration=800):
+    '''Draw an iteration count array in a single imshow() call, with the
+    points inside the set in black.'''
+    import matplotlib.pyplot as plt
+    inside = np.ma.masked_where(counts >= max_iteration, counts)
+    cmap = plt.get_cmap('magma').with_extremes(bad='black')
+    plt.imshow(inside, cmap=cmap, origin='lower',
+               extent=(*x_bounds, *y_bounds))
+    plt.xlabel('Re(c)')
+    plt.ylabel('Im(c)')
+
+
+def render_rows(shm_name, width, height, row_start, row_stop, x_bounds,
+                y_bounds, max_iteration, smooth, early_out):
+    '''Worker: compute rows [row_start, row_stop) of the image straight
+    into the shared iteration buffer, so no result is pickled back.'''
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        counts = np.ndarray((height, width), dtype=np.float64, buffer=shm.buf)
+        x_grid, y_grid = np.meshgrid(
+            np.linspace(*x_bounds, width),
+            np.linspace(*y_bounds, height)[row_start:row_stop])
+        counts[row_start:row_stop] = escape_counts(
+            x_grid.ravel(), y_grid.ravel(), max_iteration, smooth, early_out
+        ).reshape(row_stop - row_start, width)
+        # The buffer cannot be closed while an array still points into it
+        del counts
+    finally:
+        shm.close()
+
+
+def mandelbrot_counts_parallel(width=2000, height=2000, x_bounds=X_BOUNDS,
+                               y_bounds=Y_BOUNDS, max_iteration=800,
+                               smooth=False, tile_rows=16, workers=None,
+                               early_out=False):
+    '''Like mandelbrot_counts(), but split the image into bands of
+    tile_rows rows computed by a pool of worker processes (default: one
+    per CPU). Workers write into one shared memory buffer. Narrow bands
+    keep the load balanced, since rows through the set take far longer
+    than rows outside it.
+    '''
+    workers = workers or os.cpu_count()
+    shm = shared_memory.SharedMemory(create=True, size=width * height * 8)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(render_rows, shm.name, width, height, start,
+                                   min(start + tile_rows, height), x_bounds,
+                                   y_bounds, max_iteration, smooth, early_out)
+                       for start in range(0, height, tile_rows)]
+            for future in futures:
+                future.result()
+        counts = np.ndarray((height, width), dtype=np.float64,
+                            buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return counts
+
+
+def render_counts(width=1000, height=1000, max_iteration=800,
+                  x_bounds=X_BOUNDS, y_bounds=Y_BOUNDS, tile_rows=16,
+                  workers=1, early_out=False):
+    '''Smooth iteration counts, split across worker processes when
+    workers > 1.'''
+    perf.count('pixels', width * height)
+    if workers == 1:
+        return mandelbrot_counts(width, height, x_bounds, y_bounds,
+                                 max_iteration, True, early_out)
+    return mandelbrot_counts_parallel(width, height, x_bounds, y_bounds,
+                                      max_iteration, True, tile_rows, workers,
+                                      early_out)
+
+
+@time_this
+def make_mandelbrot_vectorized(width=1000, height=1000, max_iteration=800,
+                               x_bounds=X_BOUNDS, y_bounds=Y_BOUNDS,
+                               tile_rows=16, workers=1, early_out=False):
+    '''Render the set with escape_counts() and smooth coloring.'''
+    counts = render_counts(width, height, max_iteration, x_bounds, y_bounds,
+                           tile_rows, workers, early_out)
+    plot_counts(counts, x_bounds, y_bounds, max_iteration)
+
+
+def save_counts(counts, path, max_iteration=800):
+    '''Save an iteration count array as .npy, or as an image colored like
+    plot_counts() for any other extension. No GUI backend is used.'''
+    if str(path).endswith('.npy'):
+        np.save(path, counts)
+        return
+    import matplotlib
+    import matplotlib.image
+    inside = np.ma.masked_where(counts >= max_iteration, counts)
+    cmap = matplotlib.colormaps['magma'].with_extremes(bad='black')
+    matplotlib.image.imsave(path, inside, cmap=cmap, origin='lower')
+
+
+def zoom_frames(center, frames, width=800, height=800, start_width=3.0,
+                zoom_factor=0.95, max_iteration=800, early_out=False):
+    '''Yield (frame, x_bounds, y_bounds, counts) for a zoom towards
+    center, the view narrowing by zoom_factor per frame from start_width
+    units of the real axis. The same counts and coordinate arrays are
+    reused for every frame, so copy counts to keep a frame beyond the
+    next iteration.'''
+    counts = np.empty((height, width))
+    x_grid = np.empty((height, width))
+    y_grid = np.empty((height, width))
+    view_width = start_width
+    for frame in range(frames):
+        view_height = view_width * height / width
+        x_bounds = (center[0] - view_width / 2, center[0] + view_width / 2)
+        y_bounds = (center[1] - view_height / 2, center[1] + view_height / 2)
+        x_grid[:] = np.linspace(*x_bounds, width)
+        y_grid[:] = np.linspace(*y_bounds, height)[:, np.newaxis]
+        escape_counts(x_grid.ravel(), y_grid.ravel(), max_iteration,
+                      smooth=True, early_out=early_out, out=counts.ravel())
+        perf.count('frames')
+        yield frame, x_bounds, y_bounds, counts
+        view_width *= zoom_factor
+
+
+@time_this
+def export_zoom(center, frames, output_dir, file_format='png', **kwargs):
+    '''Write each frame of zoom_frames() to output_dir as
+    frame_00000.png (or .npy) as soon as it is computed.'''
+    os.makedirs(output_dir, exist_ok=True)
+    max_iteration = kwargs.get('max_iteration', 800)
+    for frame, _, _, counts in zoom_frames(center, frames, **kwargs):
+        save_counts(counts, os.path.join(output_dir,
+                                         f'frame_{frame:05}.{file_format}'),
+                    max_iteration)
+
+
+def benchmark_early_out(width=500, height=500, max_iteration=800):
+    '''Print, for each of BENCHMARK_VIEWPORTS, the point iterations and
+    time with and without early_out, and how many pixels differ.'''
+    print(f"{'viewport':<18}{'iterations':>14}{'early out':>14}{'saved':>8}"
+          f"{'time':>8}{'early':>8}{'differ':>8}")
+    for name, x_bounds, y_bounds in BENCHMARK_VIEWPORTS:
+        results = []
+        for early_out in (False, True):
+            stats = {}
+            start = time.perf_counter()
+            counts = mandelbrot_counts(width, height, x_bounds, y_bounds,
+                                       max_iteration, early_out=early_out,
+                                       stats=stats)
+            results.append((stats['point_iterations'],
+                            time.perf_counter() - start, counts))
+        (full, full_time, counts), (early, early_time, early_counts) = results
+        print(f'{name:<18}{full:>14,}{early:>14,}{1 - early / full:>8.1%}'
+              f'{full_time:>8.2f}{early_time:>8.2f}'
+              f'{np.count_nonzero(counts != early_counts):>8}')
 
 
-make_mandelbrot()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the Mandelbrot set.')
+    parser.add_argument('--width', type=int, default=1000)
+    parser.add_argument('--height', type=int, default=1000)
+    parser.add_argument('--max-iteration', type=int, default=800)
+    parser.add_argument('--x-bounds', type=float, nargs=2, default=X_BOUNDS,
+                        metavar=('MIN', 'MAX'))
+    parser.add_argument('--y-bounds', type=float, nargs=2, default=Y_BOUNDS,
+                        metavar=('MIN', 'MAX'))
+    parser.add_argument('--tile-rows', type=int, default=16,
+                        help='rows per parallel work item')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='worker processes (default: CPU count)')
+    parser.add_argument('--early-out', action='store_true',
+                        help='skip the main bulbs and stop periodic orbits')
+    parser.add_argument('--benchmark-early-out', action='store_true',
+                        help='compare iterations with and without --early-out')
+    parser.add_argument('--output',
+                        help='save to this .npy or .png file instead of plotting')
+    parser.add_argument('--zoom', type=float, nargs=2, metavar=('X', 'Y'),
+                        help='write a zoom sequence towards this point')
+    parser.add_argument('--frames', type=int, default=100,
+                        help='frames in the zoom sequence')
+    parser.add_argument('--zoom-factor', type=float, default=0.95,
+                        help='view width ratio between zoom frames')
+    parser.add_argument('--output-dir', default='frames',
+                        help='directory for zoom frames')
+    parser.add_argument('--format', choices=('png', 'npy'), default='png',
+                        help='zoom frame file format')
+    perf.add_report_arguments(parser)
+    args = parser.parse_args()
+    report = perf.Report('mandelbrot', args.trace_memory, vars(args))
+    if args.benchmark_early_out:
+        with report.measure('benchmark_early_out'):
+            benchmark_early_out(args.width, args.height, args.max_iteration)
+    elif args.zoom:
+        with report.measure('export_zoom'):
+            export_zoom(tuple(args.zoom), args.frames, args.output_dir,
+                        args.format, width=args.width, height=args.height,
+                        zoom_factor=args.zoom_factor,
+                        max_iteration=args.max_iteration,
+                        early_out=args.early_out)
+    elif args.output:
+        with report.measure('render_counts'):
+            counts = render_counts(args.width, args.height, args.max_iteration,
+                                   tuple(args.x_bounds), tuple(args.y_bounds),
+                                   args.tile_rows, args.workers,
+                                   args.early_out)
+        with report.measure('save_counts'):
+            save_counts(counts, args.output, args.max_iteration)
+    else:
+        import matplotlib.pyplot as plt
+        with report.measure('make_mandelbrot_vectorized'):
+            make_mandelbrot_vectorized(
+                args.width, args.height, args.max_iteration,
+                tuple(args.x_bounds), tuple(args.y_bounds), args.tile_rows,
+                args.workers, args.early_out)
+    if args.report:
+        report.write(args.report)
+    if not (args.benchmark_early_out or args.zoom or args.output):
+        plt.show()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+"""
+Timing, memory and counter instrumentation shared by the scripts in this
+repository, and a benchmark runner for all of them.
+
+Each script takes --report PATH to write a JSON report of its run, and
+--trace-memory to add the peak memory of each timed phase. Running this
+module benchmarks every script with fixed parameters.
+
+Use: python perf.py [--repeat N] [--trace-memory] [--output results.json]
+"""
+
+import argparse
+import collections
+import contextlib
+import functools
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# Events counted by the scripts in this process, see count()
+counters = collections.Counter()
+counters_lock = threading.Lock()
+
+
+def count(event, amount=1):
+    """Add amount to the counter of an event. Safe to call from threads,
+    but counts made in worker processes are not sent back.
+    """
+    with counters_lock:
+        counters[event] += amount
+
+
+def time_this(func):
+    '''Execution time decorator. The time is printed to stderr and added
+    to the counter '<function name>_ns'.
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter_ns()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter_ns() - start
+        count(f'{func.__name__}_ns', elapsed)
+        print(f'Execution time {func.__name__}(): {elapsed / 1e9:.6f}',
+              file=sys.stderr)
+        return result
+    return wrapper
+
+
+class Report:
+    """Timings, peak memory and counters of one run of a script."""
+
+    def __init__(self, script, trace_memory=False, parameters=None):
+        self.script = script
+        self.trace_memory = trace_memory
+        # Settings of the run, such as the script's command line arguments
+        self.parameters = parameters or {}
+        # label: {'seconds': float, 'peak_bytes': int}
+        self.phases = {}
+        self.counters_start = collections.Counter(counters)
+
+    @contextlib.contextmanager
+    def measure(self, label):
+        """Time the body of a with block as the phase 'label', and trace its
+        peak memory if trace_memory was set. tracemalloc slows allocation
+        down, so memory and timings should come from separate runs.
+        """
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            phase = {'seconds': (time.perf_counter_ns() - start) / 1e9}
+            if self.trace_memory:
+                phase['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.phases[label] = phase
+
+    def as_dict(self):
+        return {
+            'script': self.script,
+            'python': platform.python_version(),
+            'parameters': self.parameters,
+            'phases': self.phases,
+            'counters': dict(collections.Counter(counters)
+                             - self.counters_start),
+        }
+
+    def write(self, path):
+        """Write the report as JSON to path, or to stdout if path is '-'."""
+        if path == '-':
+            json.dump(self.as_dict(), sys.stdout, indent=2, default=str)
+            print()
+            return
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, default=str)
+
+
+def add_report_arguments(parser):
+    """Add --report and --trace-memory to an ArgumentParser."""
+    parser.add_argument('--report', metavar='PATH',
+                        help="write timings and counters as JSON ('-' for"
+                             ' stdout)')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='add the peak memory of each phase to --report')
+
+
+def bench_mandelbrot(report):
+    import mandelbrot
+    stats = {}
+    with report.measure('escape_counts 400x400'):
+        mandelbrot.mandelbrot_counts(400, 400, max_iteration=300, smooth=True,
+                                     stats=stats)
+    count('mandelbrot_point_iterations', stats['point_iterations'])
+    stats = {}
+    with report.measure('escape_counts 400x400 early_out'):
+        mandelbrot.mandelbrot_counts(400, 400, max_iteration=300, smooth=True,
+                                     early_out=True, stats=stats)
+    count('mandelbrot_early_out_point_iterations', stats['point_iterations'])
+    with report.measure('zoom_frames 200x200 x10'):
+        for _ in mandelbrot.zoom_frames((-0.743643887, 0.131825904), 10,
+                                        200, 200, max_iteration=300):
+            pass
+
+
+def bench_hamming(report):
+    import hamming_distance_by_seed as hamming
+    with report.measure('random_numbers 5000'):
+        nums = hamming.random_numbers(100, 5000)
+    with report.measure('hamming_histogram 5000'):
+        histogram = hamming.hamming_histogram(nums)
+    count('hamming_pairs', int(histogram.sum()))
+    with report.measure('seed_stats 781 x20'):
+        for seed in range(100, 120):
+            hamming.seed_stats(seed)
+
+
+def synthetic_feed(dates, tenors=None):
+    """Return a feed in the layout of treasury.gov with one entry per
+    YYYY-MM-DD date, rating the i-th of tenors (default: all) at
+    (day of month + i) % 50 / 10.
+    """
+    import treasury_yield_curve as treasury
+    entries = []
+    for date in dates:
+        day = int(date[8:10])
+        rates = ''.join(f'<d:{tenor}>{(day + i) % 50 / 10}</d:{tenor}>'
+                        for i, tenor in enumerate(tenors or treasury.TENORS))
+        entries.append(f'<entry><content><m:properties><d:NEW_DATE>'
+                       f'{date}T00:00:00</d:NEW_DATE>{rates}'
+                       f'</m:properties></content></entry>')
+    return (f'<feed xmlns="{treasury.ATOM[1:-1]}" xmlns:m="m" '
+            f'xmlns:d="{treasury.DATA[1:-1]}">{"".join(entries)}</feed>'
+            ).encode()
+
+
+def bench_treasury(report):
+    import treasury_yield_curve as treasury
+    # 21 trading days a month
+    feeds = [synthetic_feed([f'{year}-{month:02}-{day:02}'
+                             for day in range(1, 22)])
+             for year in range(1995, 2025) for month in range(1, 13)]
+    with report.measure('iter_feed_rates 360 months'):
+        records = [record for feed in feeds
+                   for record in treasury.iter_feed_rates(feed)]
+    count('treasury_days', len(records))
+    with tempfile.TemporaryDirectory() as path:
+        with report.measure('YieldStore.build'):
+            store = treasury.YieldStore.build(path, records)
+        with report.measure('YieldStore.rates_on x10000'):
+            for i in range(10000):
+                store.rates_on(records[i * 7 % len(records)][0])
+        with report.measure('YieldStore.inversions'):
+            store.inversions()
+        del store
+
+
+def bench_json_parser(report):
+    json_parser_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'json_parser')
+    if json_parser_dir not in sys.path:
+        sys.path.insert(0, json_parser_dir)
+    import bench
+    corpus = bench.make_corpus('api_records', 1_000_000)
+    count('json_parser_bytes', len(corpus))
+    for task in ('lex', 'parse', 'parse_fused'):
+        with report.measure(f'{task} api_records 1MB'):
+            bench.TASKS[task](corpus)
+
+
+BENCHMARKS = {
+    'mandelbrot': bench_mandelbrot,
+    'hamming_distance_by_seed': bench_hamming,
+    'treasury_yield_curve': bench_treasury,
+    'json_parser': bench_json_parser,
+}
+
+
+def run(repeat=3, trace_memory=False, scripts=None):
+    """Run the benchmark of each script and return their reports as
+    dicts. Phase times are the best of 'repeat' runs, and peak memory comes
+    from one more run if trace_memory is set.
+    """
+    results = []
+    for script in scripts or BENCHMARKS:
+        result = None
+        for _ in range(repeat):
+            report = Report(script, parameters={'repeat': repeat})
+            BENCHMARKS[script](report)
+            if result is None:
+                result = report.as_dict()
+            for label, phase in report.phases.items():
+                best = result['phases'][label]
+                best['seconds'] = min(best['seconds'], phase['seconds'])
+        if trace_memory:
+            report = Report(script, trace_memory=True)
+            BENCHMARKS[script](report)
+            for label, phase in report.phases.items():
+                result['phases'][label]['peak_bytes'] = phase['peak_bytes']
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark every script with fixed parameters.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark, the best time is kept')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='measure peak memory in one more run')
+    parser.add_argument('--script', action='append', choices=BENCHMARKS,
+                        help='script to benchmark, may be repeated'
+                             ' (default: all)')
+    parser.add_argument('--output', help='write the reports as JSON')
+    args = parser.parse_args()
+
+    # The scripts count events with 'import perf', which is not this
+    # __main__ module, so run the benchmarks from the imported one
+    import perf
+    results = perf.run(args.repeat, args.trace_memory, args.script)
+    print(f"{'phase':<45}{'seconds':>10}{'peak MB':>10}")
+    for result in results:
+        print(result['script'])
+        for label, phase in result['phases'].items():
+            peak = phase.get('peak_bytes')
+            peak = '' if peak is None else f'{peak / 1e6:.1f}'
+            print(f"  {label:<43}{phase['seconds']:>10.4f}{peak:>10}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
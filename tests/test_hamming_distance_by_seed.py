@@ -0,0 +1,44 @@
+import argparse
+import random
+
+import numpy as np
+import pytest
+
+import hamming_distance_by_seed as hamming
+
+def brute_force_histogram(nums):
+    histogram = [0] * hamming.BINS
+    for i, num1 in enumerate(nums):
+        for num2 in nums[i + 1:]:
+            histogram[bin(num1 ^ num2).count('1')] += 1
+    return histogram
+
+def test_random_numbers_match_randint():
+    random.seed(7)
+    expected = [random.randint(0, 2 ** 64 - 1) for _ in range(50)]
+    assert hamming.random_numbers(7, 50).tolist() == expected
+
+def test_hamming_histogram_matches_brute_force():
+    nums = hamming.random_numbers(100, 300)
+    # Equal numbers and all-zero/all-one numbers cover distances 0 and 64
+    nums[:3] = [0, 2 ** 64 - 1, 0]
+    expected = brute_force_histogram(nums.tolist())
+    assert expected[0] == 1 and expected[64] == 2
+    for block_size in (hamming.BLOCK_SIZE, 64, 7, 1):
+        assert hamming.hamming_histogram(nums, block_size).tolist() == expected
+
+def test_byte_popcount():
+    values = np.array([0, 1, 5, 2 ** 63, 2 ** 64 - 1, 0x0123456789abcdef],
+                      dtype=np.uint64)
+    expected = [bin(value).count('1') for value in values.tolist()]
+    assert hamming.byte_popcount(values).tolist() == expected
+    assert hamming.popcount(values).tolist() == expected
+    matrix = values[:, np.newaxis] ^ values
+    assert (hamming.byte_popcount(matrix) == hamming.popcount(matrix)).all()
+
+def test_int_at_least():
+    at_least_two = hamming.int_at_least(2)
+    assert at_least_two('2') == 2
+    for text in ('1', '0', '-3'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            at_least_two(text)
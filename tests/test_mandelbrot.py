@@ -0,0 +1,69 @@
+import math
+
+import numpy as np
+
+import mandelbrot
+
+def scalar_count(cx, cy, max_iteration, smooth=False):
+    # Escape-time loop of one point, the reference for escape_counts()
+    x = y = 0.0
+    for iteration in range(1, max_iteration + 1):
+        x, y = x * x - y * y + cx, 2 * x * y + cy
+        if x * x + y * y > 4:
+            if smooth:
+                return iteration + 1 - math.log2(0.5 * math.log(x * x + y * y))
+            return iteration
+    return max_iteration
+
+def test_escape_counts_matches_scalar_loop():
+    x_grid, y_grid = np.meshgrid(np.linspace(-2.2, 0.8, 23),
+                                 np.linspace(-1.3, 1.3, 17))
+    x_coords, y_coords = x_grid.ravel(), y_grid.ravel()
+    expected = [scalar_count(cx, cy, 100)
+                for cx, cy in zip(x_coords.tolist(), y_coords.tolist())]
+    assert mandelbrot.escape_counts(x_coords, y_coords, 100).tolist() == \
+        expected
+    out = np.empty(x_coords.size)
+    result = mandelbrot.escape_counts(x_coords, y_coords, 100, out=out)
+    assert result is out and out.tolist() == expected
+    expected = [scalar_count(cx, cy, 100, smooth=True)
+                for cx, cy in zip(x_coords.tolist(), y_coords.tolist())]
+    assert np.allclose(mandelbrot.escape_counts(x_coords, y_coords, 100,
+                                                smooth=True),
+                       expected, rtol=0, atol=1e-12)
+
+def test_mandelbrot_counts_parallel_matches_serial():
+    expected = mandelbrot.mandelbrot_counts(31, 23, max_iteration=60,
+                                            smooth=True)
+    # 23 rows do not divide into bands of 5
+    counts = mandelbrot.mandelbrot_counts_parallel(
+        31, 23, max_iteration=60, smooth=True, tile_rows=5, workers=2)
+    assert counts.shape == (23, 31)
+    assert np.array_equal(counts, expected)
+
+def test_early_out_same_counts_fewer_iterations():
+    stats, early_stats = {}, {}
+    counts = mandelbrot.mandelbrot_counts(60, 50, max_iteration=200,
+                                          stats=stats)
+    early_counts = mandelbrot.mandelbrot_counts(60, 50, max_iteration=200,
+                                                early_out=True,
+                                                stats=early_stats)
+    assert np.array_equal(counts, early_counts)
+    assert early_stats['point_iterations'] < stats['point_iterations'] / 2
+
+def test_zoom_frames_save_counts(tmp_path):
+    frames = []
+    for frame, x_bounds, y_bounds, counts in mandelbrot.zoom_frames(
+            (-0.75, 0.1), 3, width=20, height=10, zoom_factor=0.5,
+            max_iteration=50):
+        path = tmp_path / f'frame_{frame:05}.npy'
+        mandelbrot.save_counts(counts, path, 50)
+        frames.append((x_bounds, y_bounds, counts.copy()))
+    assert [x_bounds for x_bounds, _, _ in frames] == [
+        (-2.25, 0.75), (-1.5, 0.0), (-1.125, -0.375)]
+    assert frames[0][1] == (0.1 - 0.75, 0.1 + 0.75)
+    for frame, (x_bounds, y_bounds, counts) in enumerate(frames):
+        assert np.array_equal(np.load(tmp_path / f'frame_{frame:05}.npy'),
+                              counts)
+        assert np.array_equal(counts, mandelbrot.mandelbrot_counts(
+            20, 10, x_bounds, y_bounds, 50, smooth=True))
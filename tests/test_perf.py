@@ -0,0 +1,33 @@
+import json
+import os
+import subprocess
+import sys
+
+import perf
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_time_this(capsys):
+    @perf.time_this
+    def double(x):
+        return 2 * x
+
+    report = perf.Report('test')
+    assert double(21) == 42
+    assert double(1) == 2
+    out, err = capsys.readouterr()
+    assert out == '' and err.count('Execution time double()') == 2
+    assert report.as_dict()['counters']['double_ns'] > 0
+
+def test_run_as_script_keeps_script_counters(tmp_path):
+    # Running perf.py makes it __main__, while the scripts count events in
+    # the module they import as perf
+    output = tmp_path / 'results.json'
+    subprocess.run([sys.executable, 'perf.py', '--repeat', '1', '--script',
+                    'mandelbrot', '--output', output], cwd=REPO_DIR,
+                   check=True, stdout=subprocess.DEVNULL)
+    [result] = json.loads(output.read_text())
+    assert result['script'] == 'mandelbrot'
+    # Counted by mandelbrot.zoom_frames(), not by the benchmark itself
+    assert result['counters']['frames'] == 10
+    assert result['counters']['mandelbrot_point_iterations'] > 0
@@ -0,0 +1,238 @@
+import datetime
+import http.client
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import perf
+import treasury_yield_curve as treasury
+
+DAY = 24 * 60 * 60
+
+@pytest.fixture
+def downloads(monkeypatch):
+    """Replace download() with a stub returning a feed, and return the list
+    of URLs it was called with.
+    """
+    urls = []
+    def download(url):
+        urls.append(url)
+        return perf.synthetic_feed(['2024-01-02'])
+    monkeypatch.setattr(treasury, 'download', download)
+    return urls
+
+def write_cache(cache_dir, year, month, saved):
+    path = os.path.join(cache_dir, f'{year:04}{month:02}.xml')
+    with open(path, 'wb') as f:
+        f.write(b'cached')
+    os.utime(path, (saved, saved))
+    return path
+
+def test_read_feed_fixture_dir(tmp_path, downloads):
+    (tmp_path / '202401.xml').write_bytes(b'fixture')
+    assert treasury.read_feed(2024, 1, fixture_dir=tmp_path) == b'fixture'
+    with pytest.raises(FileNotFoundError):
+        treasury.read_feed(2024, 2, fixture_dir=tmp_path)
+    assert downloads == []
+
+def test_read_feed_cache_miss(tmp_path, downloads, capsys):
+    cache_dir = tmp_path / 'cache'
+    feed = treasury.read_feed(2024, 1, cache_dir=cache_dir)
+    # Progress goes to stderr, stdout is left to --range output
+    out, err = capsys.readouterr()
+    assert out == '' and '202401' in err
+    assert feed == perf.synthetic_feed(['2024-01-02'])
+    assert downloads == [treasury.FEED_URL + '202401']
+    assert (cache_dir / '202401.xml').read_bytes() == feed
+    assert os.listdir(cache_dir) == ['202401.xml']
+
+def test_read_feed_final_month_is_kept(tmp_path, downloads):
+    saved = treasury.month_end(2024, 1) + treasury.FINAL_AFTER
+    write_cache(tmp_path, 2024, 1, saved)
+    assert treasury.read_feed(2024, 1, cache_dir=tmp_path, ttl=0) == b'cached'
+    assert downloads == []
+
+def test_read_feed_month_saved_before_final_expires(tmp_path, downloads):
+    # Saved on the evening of the last day, US Eastern time, which is
+    # after the month ended in UTC
+    saved = treasury.month_end(2024, 1) + 60 * 60
+    write_cache(tmp_path, 2024, 1, saved)
+    assert not treasury.is_fresh(tmp_path / '202401.xml', 2024, 1, ttl=DAY)
+    treasury.read_feed(2024, 1, cache_dir=tmp_path, ttl=DAY)
+    assert downloads == [treasury.FEED_URL + '202401']
+
+def test_read_feed_current_month_ttl(tmp_path, downloads):
+    today = datetime.date.today()
+    path = write_cache(tmp_path, today.year, today.month, time.time() - 600)
+    assert treasury.read_feed(today.year, today.month, cache_dir=tmp_path,
+                              ttl=3600) == b'cached'
+    assert downloads == []
+    os.utime(path, (time.time() - 7200,) * 2)
+    assert treasury.read_feed(today.year, today.month, cache_dir=tmp_path,
+                              ttl=3600) == perf.synthetic_feed(['2024-01-02'])
+    assert len(downloads) == 1
+
+def test_read_feed_offline(tmp_path, downloads):
+    write_cache(tmp_path, 2024, 1, treasury.month_end(2024, 1) - DAY)
+    assert treasury.read_feed(2024, 1, cache_dir=tmp_path, ttl=0,
+                              offline=True) == b'cached'
+    with pytest.raises(FileNotFoundError):
+        treasury.read_feed(2024, 2, cache_dir=tmp_path, offline=True)
+    assert downloads == []
+
+def test_parse_xml_for_rates_fixtures(tmp_path, downloads):
+    (tmp_path / '202401.xml').write_bytes(
+        perf.synthetic_feed(['2024-01-02', '2024-01-03']))
+    rates, date = treasury.parse_xml_for_rates('2024-01-03',
+                                               fixture_dir=tmp_path)
+    assert date == '2024-01-03'
+    assert rates == [(3 + i) / 10 for i in range(len(treasury.TENORS))]
+    assert treasury.parse_xml_for_rates('2024-01-04',
+                                        fixture_dir=tmp_path) is None
+    assert downloads == []
+
+def test_months():
+    assert treasury.months('2023-11-30', '2024-02-01') == [
+        (2023, 11), (2023, 12), (2024, 1), (2024, 2)]
+    assert treasury.months('2024-01-05', '2024-01-20') == [(2024, 1)]
+
+def test_fetch_range_across_years(tmp_path, downloads):
+    (tmp_path / '202312.xml').write_bytes(
+        perf.synthetic_feed(['2023-12-27', '2023-12-28', '2023-12-29']))
+    (tmp_path / '202401.xml').write_bytes(
+        perf.synthetic_feed(['2024-01-02', '2024-01-03', '2024-01-04']))
+    for workers in (1, 4):
+        records = list(treasury.fetch_range('2023-12-28', '2024-01-03',
+                                            workers, fixture_dir=tmp_path))
+        assert [date for date, _ in records] == [
+            '2023-12-28', '2023-12-29', '2024-01-02', '2024-01-03']
+    with pytest.raises(FileNotFoundError):
+        list(treasury.fetch_range('2023-12-28', '2024-02-01',
+                                  fixture_dir=tmp_path))
+    assert downloads == []
+
+class FakeConnection:
+    """Stands in for HTTPSConnection. The first 'failures' requests fail
+    like a kept-alive connection that the server closed.
+    """
+    opened = []
+    failures = 0
+    status = 200
+    reason = 'OK'
+
+    def __init__(self, host, timeout):
+        self.closed = False
+        FakeConnection.opened.append(self)
+
+    def request(self, method, url):
+        self.url = url
+
+    def getresponse(self):
+        if FakeConnection.failures:
+            FakeConnection.failures -= 1
+            raise http.client.RemoteDisconnected('closed')
+        return self
+
+    def read(self):
+        return b'feed'
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def connections(monkeypatch):
+    monkeypatch.setattr(treasury, 'connections', threading.local())
+    monkeypatch.setattr(http.client, 'HTTPSConnection', FakeConnection)
+    monkeypatch.setattr(FakeConnection, 'opened', [])
+    return FakeConnection.opened
+
+def test_download_retries_closed_connection(connections, monkeypatch):
+    monkeypatch.setattr(FakeConnection, 'failures', 1)
+    assert treasury.download(treasury.FEED_URL + '202401') == b'feed'
+    first, second = connections
+    assert first.closed and not second.closed
+    assert second.url.endswith('field_tdr_date_value_month=202401')
+    # The new connection is kept for the next download
+    assert treasury.download(treasury.FEED_URL + '202402') == b'feed'
+    assert len(connections) == 2
+
+def test_download_retries_once(connections, monkeypatch):
+    monkeypatch.setattr(FakeConnection, 'failures', 2)
+    with pytest.raises(http.client.RemoteDisconnected):
+        treasury.download(treasury.FEED_URL + '202401')
+    assert len(connections) == 2 and all(c.closed for c in connections)
+    # A failed download does not leave a closed connection behind
+    assert treasury.download(treasury.FEED_URL + '202401') == b'feed'
+    assert len(connections) == 3
+
+def test_iter_feed_rates_missing_tenors(tmp_path):
+    # Feeds before Oct. 19, 2022 have no 4 month bill, and a feed may lack
+    # other tenors too. Each rate must stay in the slot of its tenor.
+    missing = ('BC_2MONTH', 'BC_4MONTH')
+    tenors = [tenor for tenor in treasury.TENORS if tenor not in missing]
+    feed = perf.synthetic_feed(['2019-01-02', '2019-01-03'], tenors)
+    records = list(treasury.iter_feed_rates(feed))
+    assert [date for date, _ in records] == ['2019-01-02', '2019-01-03']
+    for tenor, rate in zip(treasury.TENORS, records[0][1]):
+        if tenor in missing:
+            assert rate != rate
+        else:
+            assert rate == (2 + tenors.index(tenor)) / 10
+
+    store = treasury.YieldStore.build(tmp_path, records)
+    assert store.rates.shape == (2, len(treasury.TENORS))
+    assert store.rates_on('2019-01-03')[treasury.TENORS.index('BC_30YEAR')] \
+        == (3 + tenors.index('BC_30YEAR')) / 10
+
+def make_store(path, spreads, start='2024-01-01'):
+    """Build a store of consecutive days on which the 10 year note pays
+    the given spread over the 3 month bill.
+    """
+    long = treasury.TENORS.index('BC_10YEAR')
+    short = treasury.TENORS.index('BC_3MONTH')
+    day = datetime.date.fromisoformat(start)
+    records = []
+    for spread in spreads:
+        rates = [4.0] * len(treasury.TENORS)
+        rates[long] = rates[short] + spread
+        records.append((day.isoformat(), rates))
+        day += datetime.timedelta(days=1)
+    return treasury.YieldStore.build(path, records)
+
+def test_yield_store_between_and_spread(tmp_path):
+    store = make_store(tmp_path, [1.0, 0.5, -0.5, 0.25])
+    dates, rates = store.between('2024-01-02', '2024-01-03')
+    assert [str(date) for date in dates] == ['2024-01-02', '2024-01-03']
+    assert rates.shape == (2, len(treasury.TENORS))
+    assert len(store.between()[0]) == 4
+    assert [str(date) for date in store.between(end='2024-01-01')[0]] == [
+        '2024-01-01']
+    assert len(store.between('2024-02-01')[0]) == 0
+    dates, spread = store.spread(start='2024-01-02')
+    assert spread.tolist() == [0.5, -0.5, 0.25]
+    with pytest.raises(KeyError):
+        store.rates_on('2023-12-31')
+
+def test_yield_store_inversions(tmp_path):
+    # Inverted runs at the start, in the middle and at the end
+    store = make_store(tmp_path, [-1, -1, 1, -1, 1, 1, -1, -1])
+    assert store.inversions() == [('2024-01-01', '2024-01-02'),
+                                  ('2024-01-04', '2024-01-04'),
+                                  ('2024-01-07', '2024-01-08')]
+    assert store.inversions(start='2024-01-02', end='2024-01-05') == [
+        ('2024-01-02', '2024-01-02'), ('2024-01-04', '2024-01-04')]
+    assert store.inversions(start='2024-01-05', end='2024-01-06') == []
+
+def test_yield_store_rebuild_replaces_dates(tmp_path):
+    make_store(tmp_path, [1, 1, 1])
+    # Overlaps the last two days and adds two new ones
+    store = make_store(tmp_path, [-1, -1, -1, -1], start='2024-01-02')
+    assert len(store) == 5
+    assert store.spread()[1].tolist() == [1, -1, -1, -1, -1]
+    assert store.inversions() == [('2024-01-02', '2024-01-05')]
+    assert treasury.YieldStore(tmp_path).dates[-1] == \
+        np.datetime64('2024-01-05')
+    assert sorted(os.listdir(tmp_path)) == ['dates.npy', 'rates.npy']
@@ -3,13 +3,62 @@
 """
 Displays the U.S. Treasury securities yield curve (interest rate vs.
 bond duration) on a given trading day.
+
+Monthly XML feeds are cached on disk. Past months are kept for good once
+saved two days after they ended, the current month is downloaded again
+once the cached copy is older than --ttl seconds. --offline only reads the
+cache, and --fixtures reads feeds named YYYYMM.xml from a local directory
+instead of treasury.gov.
+
+--range START END prints the rates of every trading day in a date range,
+downloading the monthly feeds in parallel. With --store DIR the range is
+saved to a memory-mapped yield store instead, which a date or
+--inversions then reads without parsing any XML.
 """
 
 # Note: https://docs.python.org/3/library/xml.html#xml-vulnerabilities
 
-import urllib.request
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import http.client
+import io
+import math
+import os
+import sys
+import threading
+import time
+import urllib.parse
 import xml.etree.ElementTree as ET
 import matplotlib.pyplot as plt
+import numpy as np
+
+import perf
+
+FEED_URL = ('https://home.treasury.gov/resource-center/data-chart-center/'
+            'interest-rates/pages/xml?data=daily_treasury_yield_curve&'
+            'field_tdr_date_value_month=')
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                         'treasury_yield_curve')
+# Seconds before a cached feed of the current month is downloaded again
+CACHE_TTL = 60 * 60
+# Seconds after the end of a month (UTC) before its feed is final. The last
+# day is published in the evening, US Eastern time, which is already the
+# next day in UTC, and may be revised the day after.
+FINAL_AFTER = 2 * 24 * 60 * 60
+# Feed tags of the rates, in order of duration. BC_4MONTH starts on
+# Oct. 19, 2022.
+TENORS = ('BC_1MONTH', 'BC_2MONTH', 'BC_3MONTH', 'BC_4MONTH', 'BC_6MONTH',
+          'BC_1YEAR', 'BC_2YEAR', 'BC_3YEAR', 'BC_5YEAR', 'BC_7YEAR',
+          'BC_10YEAR', 'BC_20YEAR', 'BC_30YEAR')
+# Duration of each tenor in years
+TENOR_YEARS = (1 / 12, 1 / 6, 1 / 4, 1 / 3, 1 / 2, 1, 2, 3, 5, 7, 10, 20, 30)
+# The XML tags are all prepended by a URL.
+ATOM = '{http://www.w3.org/2005/Atom}'
+DATA = '{http://schemas.microsoft.com/ado/2007/08/dataservices}'
+# One HTTPS connection per thread, kept open between feeds
+connections = threading.local()
 
 
 def prompt_date():
@@ -29,43 +78,240 @@ def prompt_date():
     return date
 
 
-def parse_xml_for_rates():
-    """Pull and parse XML data from the Treasury Dept. website. This
-    function may break if the XML URL or file structure changes.
+def month_end(year, month):
+    """Return the Unix time at which a month ends in UTC."""
+    if month == 12:
+        year, month = year + 1, 0
+    return datetime.datetime(year, month + 1, 1,
+                             tzinfo=datetime.timezone.utc).timestamp()
+
+
+def is_fresh(path, year, month, ttl=CACHE_TTL):
+    """Whether a cached feed can be used without downloading it again.
+    A feed saved FINAL_AFTER seconds after its month ended is complete and
+    never expires.
     """
-    url = ['https://home.treasury.gov/resource-center/data-chart-center/',
-           'interest-rates/pages/xml?data=daily_treasury_yield_curve&',
-           'field_tdr_date_value_month=']
-    date = prompt_date()
+    saved = os.path.getmtime(path)
+    return (saved >= month_end(year, month) + FINAL_AFTER
+            or time.time() - saved < ttl)
+
+
+def download(url):
+    """Return the body of a GET request, reusing this thread's connection
+    to the host.
+    """
+    parts = urllib.parse.urlsplit(url)
+    for attempt in range(2):
+        connection = getattr(connections, parts.netloc, None)
+        if connection is None:
+            connection = http.client.HTTPSConnection(parts.netloc, timeout=60)
+            setattr(connections, parts.netloc, connection)
+        try:
+            connection.request('GET', f'{parts.path}?{parts.query}')
+            response = connection.getresponse()
+            data = response.read()
+            break
+        except (http.client.HTTPException, ConnectionError):
+            # The server closed the kept-alive connection, open a new one
+            connection.close()
+            delattr(connections, parts.netloc)
+            if attempt:
+                raise
+    if response.status != 200:
+        raise OSError(f'{url}: HTTP {response.status} {response.reason}')
+    return data
+
+
+def read_feed(year, month, cache_dir=CACHE_DIR, ttl=CACHE_TTL, offline=False,
+              fixture_dir=None):
+    """Return the XML feed of a month as bytes, from fixture_dir if given,
+    else from the cache in cache_dir or treasury.gov.
+    """
+    name = f'{year:04}{month:02}.xml'
+    if fixture_dir is not None:
+        path = os.path.join(fixture_dir, name)
+    else:
+        path = os.path.join(cache_dir, name)
+        if not os.path.exists(path) or \
+                not (offline or is_fresh(path, year, month, ttl)):
+            if offline:
+                raise FileNotFoundError(f'{path} is not cached')
+            # stderr, as --range prints the rates to stdout
+            print(f'Connecting to treasury.gov for {name[:6]}...',
+                  file=sys.stderr)
+            perf.count('feed_downloads')
+            data = download(FEED_URL + name[:6])
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to a temporary file first so that an interrupted
+            # download never leaves a truncated feed in the cache
+            temp_path = f'{path}.{os.getpid()}.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            return data
+
+    perf.count('feed_file_reads')
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def parse_xml_for_rates(date=None, **feed_options):
+    """Pull and parse XML data from the Treasury Dept. website, or the
+    cache (see read_feed() for feed_options). Prompt for a date if none is
+    given. This function may break if the XML URL or file structure
+    changes.
+    """
+    if date is None:
+        date = prompt_date()
     year, month, day = date.split('-')
-    url.append(year)
-    url.append(month)
-    url = ''.join(url)
-
-    content_start_index = 0
-    # Treasury changed XML structure on Oct. 19, 2022.
-    IS_OLD_XML_FORMAT = int(year) <= 2022 and int(month) <= 10 \
-                        and int(day) <= 18
-    if IS_OLD_XML_FORMAT:
-        content_start_index = 1
-
-    print('Connecting to treasury.gov...')
-    with urllib.request.urlopen(url) as page:
-        print('Reading XML...')
-        tree = ET.parse(page)
-    root = tree.getroot()
-
-    # The XML tags in the tree variable are all prepended by a URL.
-    for entry in root.findall('{http://www.w3.org/2005/Atom}entry'):
-        for content in entry.find('{http://www.w3.org/2005/Atom}content'):
-            if content[content_start_index].text[:10] == date:
-                rates = []
-                for ind, child in enumerate(content):
-                    if ind > content_start_index:
-                        rates.append(float(child.text))
-                # Remove repeated 30-year rate (due to XML format)
-                rates.pop()
-                return rates, date
+
+    feed = read_feed(int(year), int(month), **feed_options)
+    print('Reading XML...')
+    for entry_date, rates in iter_feed_rates(feed):
+        if entry_date == date:
+            return rates, date
+
+
+def iter_feed_rates(feed):
+    """Yield (date, rates) for each day of a monthly XML feed. Rates are
+    in TENORS order, NaN where the feed has no value or no tag for a tenor,
+    such as the 4 month bill before Oct. 19, 2022. Elements are cleared
+    once read, so memory use does not grow with the feed.
+    """
+    events = ET.iterparse(io.BytesIO(feed), events=('start', 'end'))
+    _, root = next(events)
+    for event, element in events:
+        if event != 'end' or element.tag != ATOM + 'entry':
+            continue
+        values = {}
+        for child in element.iter():
+            if child.tag.startswith(DATA):
+                values[child.tag[len(DATA):]] = child.text
+        # Entries are children of the root, clear them from it as well
+        root.clear()
+        if 'NEW_DATE' not in values:
+            continue
+        yield values['NEW_DATE'][:10], [
+            math.nan if values.get(tenor) is None else float(values[tenor])
+            for tenor in TENORS]
+
+
+def months(start, end):
+    """Return (year, month) for every month from start to end, dates as
+    YYYY-MM-DD.
+    """
+    year, month = int(start[:4]), int(start[5:7])
+    end_year, end_month = int(end[:4]), int(end[5:7])
+    result = []
+    while (year, month) <= (end_year, end_month):
+        result.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return result
+
+
+def fetch_range(start, end, workers=8, **feed_options):
+    """Yield (date, rates) for each trading day from start to end
+    inclusive, in date order. Monthly feeds are read by a pool of threads
+    (see read_feed() for feed_options), at most 2 * workers ahead of the
+    feed being parsed, so memory use does not grow with the range.
+    """
+    def parse(future):
+        perf.count('feeds_parsed')
+        for date, rates in iter_feed_rates(future.result()):
+            if start <= date <= end:
+                perf.count('days')
+                yield date, rates
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        for year_month in months(start, end):
+            pending.append(pool.submit(read_feed, *year_month, **feed_options))
+            if len(pending) > 2 * workers:
+                yield from parse(pending.popleft())
+        while pending:
+            yield from parse(pending.popleft())
+
+
+class YieldStore:
+    """Daily rates of every tenor, stored as a sorted array of dates and a
+    dates x TENORS array of rates. Both are .npy files in one directory,
+    memory-mapped rather than read, so opening a store of decades of data
+    is instant.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dates = np.load(os.path.join(path, 'dates.npy'), mmap_mode='r')
+        self.rates = np.load(os.path.join(path, 'rates.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.dates)
+
+    @classmethod
+    def build(cls, path, records):
+        """Add (date, rates) records to the store at path, creating it if
+        needed, and return the store. New records replace stored ones of
+        the same date.
+        """
+        dates = []
+        rates = []
+        for date, day_rates in records:
+            dates.append(date)
+            rates.append(day_rates)
+        dates = np.array(dates, dtype='datetime64[D]')
+        rates = np.array(rates, dtype=np.float64).reshape(-1, len(TENORS))
+        if os.path.exists(os.path.join(path, 'dates.npy')):
+            old = cls(path)
+            dates = np.concatenate((dates, old.dates))
+            rates = np.concatenate((rates, old.rates))
+            del old
+        # np.unique keeps the first of equal dates, which is the new record
+        dates, first = np.unique(dates, return_index=True)
+        rates = rates[first]
+
+        os.makedirs(path, exist_ok=True)
+        for name, array in (('rates', rates), ('dates', dates)):
+            temp_path = os.path.join(path, f'{name}.{os.getpid()}.tmp.npy')
+            np.save(temp_path, array)
+            os.replace(temp_path, os.path.join(path, f'{name}.npy'))
+        return cls(path)
+
+    def index(self, date):
+        """Return the row of a date by binary search, or raise KeyError."""
+        day = np.datetime64(date, 'D')
+        i = np.searchsorted(self.dates, day)
+        if i == len(self.dates) or self.dates[i] != day:
+            raise KeyError(date)
+        return i
+
+    def rates_on(self, date):
+        """Return the rates of one day, NaN where there is no rate."""
+        return self.rates[self.index(date)]
+
+    def between(self, start=None, end=None):
+        """Return views of the dates and rates from start to end inclusive."""
+        first = 0 if start is None else \
+            np.searchsorted(self.dates, np.datetime64(start, 'D'))
+        stop = len(self.dates) if end is None else \
+            np.searchsorted(self.dates, np.datetime64(end, 'D'), 'right')
+        return self.dates[first:stop], self.rates[first:stop]
+
+    def spread(self, long='BC_10YEAR', short='BC_3MONTH', start=None,
+               end=None):
+        """Return the dates and the long minus short tenor rates."""
+        dates, rates = self.between(start, end)
+        return dates, rates[:, TENORS.index(long)] - rates[:, TENORS.index(short)]
+
+    def inversions(self, long='BC_10YEAR', short='BC_3MONTH', start=None,
+                   end=None):
+        """Return (first date, last date) of each run of days on which the
+        short tenor paid more than the long one.
+        """
+        dates, spread = self.spread(long, short, start, end)
+        inverted = np.concatenate(([False], spread < 0, [False]))
+        edges = np.flatnonzero(inverted[1:] != inverted[:-1])
+        return [(str(dates[first]), str(dates[stop - 1]))
+                for first, stop in edges.reshape(-1, 2)]
 
 
 def plot_rates(rates_and_date: tuple):
@@ -77,11 +323,11 @@ def plot_rates(rates_and_date: tuple):
             'not configured to read Treasury data from before 2019, '
             'roughly.')
         return
-    year, month, day = date.split('-')
-    x_values = (1 / 12, 1 / 6, 1 / 4, 1 / 3, 1 / 2, 1, 2, 3, 5, 7, 10, 20, 30)
     # Treasury added a new data point on Oct. 19, 2022, the 4 month bill.
-    if int(year) <= 2022 and int(month) <= 10 and int(day) <= 18:
-        x_values = (1 / 12, 1 / 6, 1 / 4, 1 / 2, 1, 2, 3, 5, 7, 10, 20, 30)
+    # Earlier days have no rate for it, which is left out of the plot.
+    rates = np.asarray(rates, dtype=np.float64)
+    x_values = np.asarray(TENOR_YEARS)[~np.isnan(rates)]
+    rates = rates[~np.isnan(rates)]
 
     plt.xlabel('Duration (years)')
     plt.ylabel('Annualized Interest Rate (%)')
@@ -97,4 +343,68 @@ def plot_rates(rates_and_date: tuple):
         return
 
 
-plot_rates(parse_xml_for_rates())
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Plot the U.S. Treasury yield curve of a trading day.')
+    parser.add_argument('date', nargs='?',
+                        help='trading day as YYYY-MM-DD (default: ask)')
+    parser.add_argument('--cache-dir', default=CACHE_DIR,
+                        help=f'directory of cached feeds (default: {CACHE_DIR})')
+    parser.add_argument('--ttl', type=float, default=CACHE_TTL,
+                        help='seconds before the current month is downloaded'
+                             ' again')
+    parser.add_argument('--offline', action='store_true',
+                        help='only use cached feeds')
+    parser.add_argument('--fixtures', metavar='DIR',
+                        help='read YYYYMM.xml feeds from this directory')
+    parser.add_argument('--range', nargs=2, metavar=('START', 'END'),
+                        help='print the rates of each day from START to END')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='parallel downloads for --range')
+    parser.add_argument('--store', metavar='DIR',
+                        help='yield store to save --range to, or to read from')
+    parser.add_argument('--inversions', action='store_true',
+                        help='print the periods in the store when the 3 month'
+                             ' bill paid more than the 10 year note')
+    perf.add_report_arguments(parser)
+    args = parser.parse_args()
+    if args.inversions and not args.store:
+        parser.error('--inversions needs --store')
+    report = perf.Report('treasury_yield_curve', args.trace_memory, vars(args))
+    feed_options = {'cache_dir': args.cache_dir, 'ttl': args.ttl,
+                    'offline': args.offline, 'fixture_dir': args.fixtures}
+    plot = not (args.range or args.inversions)
+    if plot:
+        date = args.date or prompt_date()
+    try:
+        if args.range and args.store:
+            with report.measure('fetch_range'):
+                store = YieldStore.build(args.store, fetch_range(
+                    *args.range, args.workers, **feed_options))
+            print(f'{len(store)} days in {args.store}')
+        elif args.range:
+            with report.measure('fetch_range'):
+                for date, rates in fetch_range(*args.range, args.workers,
+                                               **feed_options):
+                    print(date, *rates, sep='\t')
+        elif args.inversions:
+            with report.measure('inversions'):
+                inversions = YieldStore(args.store).inversions()
+            for first, last in inversions:
+                print(first, last, sep='\t')
+        elif args.store:
+            with report.measure('rates_on'):
+                try:
+                    rates_and_date = (
+                        list(YieldStore(args.store).rates_on(date)), date)
+                except KeyError:
+                    rates_and_date = None
+        else:
+            with report.measure('parse_xml_for_rates'):
+                rates_and_date = parse_xml_for_rates(date, **feed_options)
+    except FileNotFoundError as error:
+        raise SystemExit(error)
+    if args.report:
+        report.write(args.report)
+    if plot:
+        plot_rates(rates_and_date)